@@ -1,15 +1,19 @@
 import os, psutil, logging, platform, resource, time, sys
 
-def log_rss_memory_usage(msg=''):
-	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-	if platform.system() == 'Darwin':
-		max_rss = max_rss/1e6
-	else:
-		max_rss = max_rss/1e3
+_process = psutil.Process(os.getpid())
+_log = logging.getLogger(__name__)
+#ru_maxrss is in bytes on macOS and in kilobytes on linux
+_MAX_RSS_TO_MB = 1e6 if platform.system() == 'Darwin' else 1e3
 
-	rss = psutil.Process(os.getpid()).memory_info().rss
-	thislog = logging.getLogger(__name__)
-	thislog.info('Memory usage: {:.2f} MB. (Peak so far: {:.2f} MB) {}'.format(rss/1e6, max_rss, msg))
+def log_rss_memory_usage(msg=''):
+	if not _log.isEnabledFor(logging.INFO):
+		return
+	max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/_MAX_RSS_TO_MB
+	global _process
+	if _process.pid != os.getpid(): #forked child
+		_process = psutil.Process(os.getpid())
+	rss = _process.memory_info().rss
+	_log.info('Memory usage: %.2f MB. (Peak so far: %.2f MB) %s', rss/1e6, max_rss, msg)
 
 def get_memory_status():
 	return psutil.virtual_memory()
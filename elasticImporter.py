@@ -1,19 +1,47 @@
 # -*- coding: utf-8 -*-
 # encoding=utf8
 import sys
-if sys.version_info >= (3,0,0):
-	long = int
 import elasticsearch_dsl
 es_dsl_version = elasticsearch_dsl.__version__
 from six import iteritems
+from six.moves import queue
 from elasticsearch import Elasticsearch, helpers
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
 from elasticsearch_dsl import *
 from elasticsearch_dsl.connections import connections
-import fileinput, logging, argparse, gc, codecs, json, math, hashlib, signal, os, traceback, time
+import fileinput, logging, argparse, gc, json, hashlib, re, signal, os, traceback, time
 from argparse import RawTextHelpFormatter
 from datetime import datetime
 from threading import Thread, Event
+from array import array
 from debug_utils import log_rss_memory_usage
+try:
+	import orjson
+	def json_dumps(obj):
+		return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+	orjson = None
+	json_dumps = json.dumps
+
+class ORJsonSerializer(JSONSerializer):
+	"""Serializer of the elasticsearch client that encodes and decodes with orjson.
+	Falls back to JSONSerializer for the values orjson can not encode, like integers with more than 64 bits.
+	"""
+
+	def dumps(self, data):
+		if isinstance(data, str):
+			return data
+		try:
+			return orjson.dumps(data, default=self.default).decode('utf-8')
+		except TypeError:
+			return super(ORJsonSerializer, self).dumps(data)
+
+	def loads(self, s):
+		try:
+			return orjson.loads(s)
+		except ValueError as e:
+			raise SerializationError(s, e)
 
 log = logging.getLogger(__name__)
 logging.basicConfig(format="[ %(asctime)s %(levelname)s %(process)s ] " + "%(message)s", level=logging.INFO)
@@ -21,6 +49,11 @@ args = None
 translate_cfg_property = None
 es_version = None
 geo = None
+INPUT_BUFFER_SIZE = 1 << 17 #128 KiB
+PROGRESS_INTERVAL = 2 #seconds between progress log lines
+MAX_FAILED_ITEMS = 1000 #failed line numbers kept in memory before logging and clearing them
+MAX_TRACEBACKS = 10 #tracebacks printed for the lines that can not be processed
+WORKER_CHECK_INTERVAL = 1 #seconds waiting for the results of the bulk processes before checking that they are alive
 
 if es_dsl_version >= (6, 0, 0):
 	#no string object
@@ -46,9 +79,10 @@ def parse_args():
 	parser.add_argument('--dates_in_seconds', dest='dates_in_seconds', default=False, action='store_true', help='If true, assume dates are provided in seconds.')
 	parser.add_argument('--refresh', dest='refresh', default=False, action='store_true', help='Refresh the index when finished.')
 	parser.add_argument('--delete', dest='delete', default=False, action='store_true', help='Delete the index before process.')
-	parser.add_argument('--utf8', dest='utf8', default=False, action='store_true', help='Change the default encoding to utf8. In python2 performance is drastically affected. No effect in python3.')
+	parser.add_argument('--utf8', dest='utf8', default=False, action='store_true', help='Deprecated. No effect, the input is always decoded as utf8.')
 	parser.add_argument('-X', '--extra_data', dest='extra_data', required=False, default=None, help='Pairs field:value with value beeing a keyword string that will be indexed with each document. Multiple pairs allowed with \';;;\' as separator. For example: --extra_data \'service:mail;;;host:mailserver\'')
 	parser.add_argument('--typed_iterator', dest='typed_iterator', default=False, action='store_true', help='If true, use a typed iterator that checks the value types and parses them. Reduces performance.')
+	parser.add_argument('--pandas_iterator', dest='pandas_iterator', default=False, action='store_true', help='If true, use a typed iterator that parses the input with pandas in chunks of --bulk lines. Faster than --typed_iterator with many numeric columns. Not compatible with --md5_id, in that case --typed_iterator is used.')
 	#meta stuff to consider when creating indices
 	parser.add_argument('--replicas', dest='replicas', default=0, help='Number of replicas for the index if it does not exist. Default: 0')
 	parser.add_argument('--shards', dest='shards', default=2, help='Number of shards for the index if it does not exist. Default: 2')
@@ -57,9 +91,13 @@ def parse_args():
 	parser.add_argument('--no_all', dest='no_all', default=False, action='store_true', help='If true, do not index _all field.')
 	parser.add_argument('--deflate_compression', dest='deflate_compression', default=False, action='store_true', help='Store compression level in Lucene indices. Elasticsearch default is usually LZ4. This option enables best_compression using DEFLATE compression. More information: https://www.elastic.co/blog/store-compression-in-lucene-and-elasticsearch')
 	#index sutff for elastic
-	parser.add_argument('--bulk', dest='bulk', required=False, default=2000, type=int, help='Elasticsearch bulk size parameter. Default: 2000')
+	parser.add_argument('--bulk', dest='bulk', required=False, default=5000, type=int, help='Elasticsearch bulk size parameter. Default: 5000')
+	parser.add_argument('--max_chunk_bytes', dest='max_chunk_bytes', required=False, default=10*1024*1024, type=int, help='Maximum size in bytes of each bulk request. Default: 10485760 (10MB)')
 	parser.add_argument('--threads', dest='threads', required=False, default=5, type=int, help='Number of threads for the parallel bulk. Default: 5')
-	parser.add_argument('--queue', dest='queue', required=False, default=6, type=int, help='Size of the task queue between the main thread (producing chunks to send) and the processing threads. Default: 6')
+	parser.add_argument('--queue', dest='queue', required=False, default=6, type=int, help='Size of the task queue between the main thread (producing chunks to send) and the processing threads. Also the number of batches of --bulk documents buffered between the thread reading the input and the main thread. Default: 6')
+	parser.add_argument('--bulk_mode', dest='bulk_mode', required=False, default='parallel', choices=['parallel', 'streaming'], help='Bulk helper used to index. parallel: parallel_bulk with --threads threads. streaming: streaming_bulk from a single thread, avoids the contention between threads when the producer is the bottleneck. Default: parallel')
+	parser.add_argument('--processes', dest='processes', required=False, default=1, type=int, help='Number of processes sending the bulk requests, each one with its own connections and --threads threads. Documents with _id (--md5_id) are assigned to a process by the hash of the _id. With more than one process only the number of failed documents is reported. Default: 1')
+	parser.add_argument('--http_compress', dest='http_compress', default=False, action='store_true', help='Ask elasticsearch to compress the responses with gzip. Useful with big bulk sizes because the bulk response contains one item per document.')
 	parser.add_argument('--timeout', dest='timeout', required=False, type=int, default=600, help='Connection timeout in seconds. Default: 600')
 	#internal stuff for the elastic API
 	parser.add_argument('--debug', dest='debug', default=False, action='store_true', help='If true log level is set to DEBUG.')
@@ -107,6 +145,8 @@ def parse_args():
 
 	if len(args.regenerate_databases) == 0 and not args.cfg:
 		parser.error("-c or --cfg required.")
+	elif not args.separator:
+		parser.error("The separator can not be empty.")
 	elif len(args.regenerate_databases) > 0:
 		path = get_script_path()
 		import geodb
@@ -187,6 +227,20 @@ def parse_args():
 def get_script_path():
 	return os.path.dirname(os.path.realpath(sys.argv[0]))
 
+#ELASTICSEARCH STUFF
+def get_connection_kwargs(args):
+	"""Returns the keyword arguments for the elasticsearch connections.
+	The connection pool keeps one persistent (keep-alive) connection per bulk thread.
+	"""
+	kwargs = {'timeout': args.timeout, 'port': args.port, 'maxsize': args.threads}
+	if args.user is not None:
+		kwargs['http_auth'] = (args.user, args.password)
+	if args.http_compress:
+		kwargs['headers'] = {'accept-encoding': 'gzip,deflate'}
+	if orjson is not None:
+		kwargs['serializer'] = ORJsonSerializer()
+	return kwargs
+
 #TOR STUFF
 def get_torinfo_field():
 	extra_tor_fields = {}
@@ -283,45 +337,16 @@ def load_geo_database(level, debug):
 
 #END OF GEO LOCATION STUFF
 
+TYPE_MAP_2X  = {'date': Date, 'text': String, 'keyword': lambda: String(index="not_analyzed"), 'integer': Integer, 'long': Long, 'float': Float, 'geopoint': GeoPoint, 'ip': Ip, 'boolean': Boolean}
+TYPE_MAP_STD = {'date': Date, 'text': Text, 'keyword': Keyword, 'integer': Integer, 'long': Long, 'float': Float, 'geopoint': GeoPoint, 'ip': Ip, 'boolean': Boolean}
+
 def translate_cfg_property_2x(v):
-	if v == 'date':
-		return Date()
-	elif v == 'text':
-		return String()
-	elif v == 'keyword':
-		return String(index="not_analyzed")
-	elif v == 'integer':
-		return Integer()
-	elif v == 'long':
-		return Long()
-	elif v == 'float':
-		return Float()
-	elif v == 'geopoint':
-		return GeoPoint()
-	elif v == 'ip':
-		return Ip()
-	elif v == 'boolean':
-		return Boolean()
+	field_class = TYPE_MAP_2X.get(v)
+	return field_class() if field_class is not None else None
 
 def translate_cfg_property_std(v):
-	if v == 'date':
-		return Date()
-	elif v == 'text':
-		return Text()
-	elif v == 'keyword':
-		return Keyword()
-	elif v == 'integer':
-		return Integer()
-	elif v == 'long':
-		return Long()
-	elif v == 'float':
-		return Float()
-	elif v == 'geopoint':
-		return GeoPoint()
-	elif v == 'ip':
-		return Ip()
-	elif v == 'boolean':
-		return Boolean()
+	field_class = TYPE_MAP_STD.get(v)
+	return field_class() if field_class is not None else None
 
 def create_doc_class(cfg, doc_type, args):
 	global translate_cfg_property
@@ -330,15 +355,9 @@ def create_doc_class(cfg, doc_type, args):
 		translate_func = translate_cfg_property_std
 
 	#store dates
-	date_fields = []
+	args.date_fields = [k for k, v in cfg['properties'].items() if v == 'date']
 	#create class
-	dicc = {}
-	for k, v in cfg['properties'].items():
-		dicc[k] = translate_func(v)
-		if v == 'date':
-			date_fields.append(k)
-
-	args.date_fields = date_fields
+	dicc = {k: translate_func(v) for k, v in cfg['properties'].items()}
 
 	if args.geo_precission is not None:
 		extra_geo_fields = get_geodata_field(args.geo_precission)
@@ -368,32 +387,40 @@ def nested_set(d, keys, val):
 		d = d.setdefault(key, {})
 	d[keys[-1]] = val
 
+INF = float('inf')
 def is_nan_or_inf(value):
-	if math.isinf(value) or math.isnan(value):
-		log.debug('Nan or inf encountered in value: |{}|.'.format(value))
-		return True
-	else:
-		return False
+	#nan is the only value not equal to itself
+	return value != value or value == INF or value == -INF
+
+def parse_integer(str_value, dates_in_seconds):
+	if str_value == '':
+		return None
+	float_value = float(str_value)
+	return None if float_value != float_value or float_value == INF or float_value == -INF else int(float_value)
+
+def parse_date(str_value, dates_in_seconds):
+	if str_value == '':
+		return None
+	float_value = float(str_value)
+	if float_value != float_value or float_value == INF or float_value == -INF:
+		return None
+	return int(float_value*1000) if dates_in_seconds else int(float_value)
+
+def parse_float(str_value, dates_in_seconds):
+	if str_value == '':
+		return None
+	float_value = float(str_value)
+	return None if float_value != float_value or float_value == INF or float_value == -INF else float_value
+
+def parse_string(str_value, dates_in_seconds):
+	return str_value
 
-numeric_properties = set(('integer', 'long', 'date', 'float'))
-def parse_property(str_value, t, args):
+#any other type (text, keyword, ip, geopoint...) is kept as a string
+PARSE_DISPATCH = {'integer': parse_integer, 'long': parse_integer, 'date': parse_date, 'float': parse_float}
+
+def parse_property(str_value, t, dates_in_seconds):
 	try:
-		if t in numeric_properties:
-			if str_value == '':
-				return None
-			float_value = float(str_value)
-			if is_nan_or_inf(float_value):
-				return None
-		if t == 'integer':
-			return int(float_value)
-		if t == 'long':
-			return long(float_value)
-		elif t == 'date':
-			return int(float_value*1000) if args.dates_in_seconds else int(float_value)
-		elif t == 'float':
-			return float_value
-		else: # t == 'text' or t == 'keyword' or t == 'ip' or t == 'geopoint':
-			return str_value
+		return PARSE_DISPATCH.get(t, parse_string)(str_value, dates_in_seconds)
 	except ValueError:
 		log.warning('ValueError processing value |{}| of type |{}| ignoring this field.'.format(str_value, t))
 		return None
@@ -401,10 +428,28 @@ def parse_property(str_value, t, args):
 		log.warning('TypeError processing value |{}| of type |{}| ignoring this field.'.format(str_value, t))
 		return None
 
+def get_parse_plan(cfg):
+	"""Compiles the cfg into a tuple with the (field, type, parse function) of each column, in the order of the file."""
+	return tuple((field, cfg['properties'][field], PARSE_DISPATCH.get(cfg['properties'][field], parse_string)) for field in cfg['order_in_file'])
+
+def parse_line(sline, parse_plan, dates_in_seconds):
+	"""Parses the values of a line with the parse plan of get_parse_plan.
+	The parse functions are called directly and parse_property is only used to report the invalid values.
+	"""
+	if len(sline) > len(parse_plan):
+		raise ValueError('More fields than columns in the cfg file.')
+	dicc = {}
+	for (field, t, parse), value in zip(parse_plan, sline):
+		try:
+			dicc[field] = parse(value, dates_in_seconds)
+		except (ValueError, TypeError):
+			dicc[field] = parse_property(value, t, dates_in_seconds)
+	return dicc
+
 def geo_append(dicc, args):
 	if args.geo_precission == 'ip':
 		geo_value = dicc.get(args.geo_column_ip, None)
-		geo_data = args.geodb.get_geodata('ip', geo_value, str_ip=(not args.geo_int_ip))
+		geo_data = args.geodb.get_geodata_single('ip', geo_value, str_ip=(not args.geo_int_ip))
 	else:
 		geo_columns = []
 		geo_values = []
@@ -413,54 +458,101 @@ def geo_append(dicc, args):
 			if geo_value is not None:
 				geo_columns.append(db_column)
 				geo_values.append(geo_value.upper())
-		geo_data = args.geodb.get_geodata(geo_columns, geo_values)
+		geo_data = args.geodb.get_geodata_multi(geo_columns, geo_values)
 	#end if
+	return add_geo_data(dicc, geo_data)
+
+def add_geo_data(dicc, geo_data):
 	if geo_data is not None:
 		for gkey, gvalue in iteritems(geo_data):
 			dicc['geo_'+gkey] = gvalue
-
 	return dicc
 
-def md5_calc(dicc, fields, args):
-	md5_dicc = {}
-	for idx, field in enumerate(fields):
-		if field not in args.md5_exclude:
-			md5_dicc[field] = dicc[field]
-	return hashlib.md5(json.dumps(md5_dicc)).hexdigest()
+def tor_append(dicc, args):
+	aux_tor_check_val = dicc.get(args.tor_info_from, None)
+	try:
+		dicc['tor_info'] = args.tor_info.getTorInfo(aux_tor_check_val, int_ip=args.tor_int_ip)
+		dicc['tor_is_exit_node'] = args.tor_info.isExitNode(aux_tor_check_val, int_ip=args.tor_int_ip)
+		dicc['tor_is_tor_server'] = args.tor_info.isTorServer(aux_tor_check_val, int_ip=args.tor_int_ip)
+	except Exception as e:
+		log.warning('Exception in tor_info module. Might be an invalid IP: |{}| Details: {}'.format(aux_tor_check_val, str(e)))
+		dicc['tor_info'] = 'Invalid IP'
+	return dicc
 
-def typed_iterator(cfg, index, doc_type, args, f):
-	ctr = 0
-	for line in f:
+def open_input(path):
+	"""Opens the input file in binary mode with a big buffer, so there is no newline translation nor decoding of the whole file. The lines are decoded by the iterators.
+	Where available, the kernel is told that the file is read sequentially so it reads ahead more.
+	"""
+	f = open(path, 'rb', buffering=INPUT_BUFFER_SIZE)
+	if hasattr(os, 'posix_fadvise'):
+		try:
+			os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		except OSError:
+			pass #not supported by the file (e.g. a pipe)
+	return f
+
+def get_md5_mask(fields, args):
+	"""Returns a list with True for the columns included in the MD5 hash."""
+	return [field not in args.md5_exclude for field in fields]
+
+def md5_calc(raw_values, md5_mask):
+	"""Computes the MD5 hash of the raw (bytes) values of a line skipping the columns excluded by the mask."""
+	h = hashlib.md5()
+	for value, included in zip(raw_values, md5_mask):
+		if included:
+			h.update(value)
+			h.update(b'\x1f')
+	return h.hexdigest()
+
+def get_line_parser(cfg, args):
+	"""Returns a parse_utils.TypedLineParser if numba is available and the separator is a single ascii character, otherwise None."""
+	if len(args.separator) != 1 or ord(args.separator) > 127:
+		return None
+	from parse_utils import NUMBA_AVAILABLE, TypedLineParser
+	if not NUMBA_AVAILABLE:
+		return None
+	log.info('Using numba to parse the typed values.')
+	types = [cfg['properties'][field] for field in cfg['order_in_file']]
+	return TypedLineParser(cfg['order_in_file'], types, args.separator, args.dates_in_seconds, lambda str_value, t: parse_property(str_value, t, args.dates_in_seconds))
+
+def typed_iterator(cfg, args, f):
+	line_parser = get_line_parser(cfg, args)
+	md5_mask = get_md5_mask(cfg['order_in_file'], args)
+	raw_separator = args.separator.encode('utf-8')
+	#local copies of the values used in the loop
+	parse_plan = get_parse_plan(cfg)
+	separator = args.separator
+	skip_first_line = args.skip_first_line
+	dates_in_seconds = args.dates_in_seconds
+	md5_id = args.md5_id
+	geo_precission = args.geo_precission
+	tor_info = args.tor_info
+	extra_data = args.extra_data
+	printed_tracebacks = 0
+	if skip_first_line:
+		next(f, None)
+	for ctr, line in enumerate(f, 2 if skip_first_line else 1):
 		try:
-			if ctr == 0 and args.skip_first_line:
-				ctr+=1
-				continue
-			ctr+=1
-			sline = line.rstrip().split(args.separator)
-			dicc = {cfg['order_in_file'][i]: parse_property(value, cfg['properties'][cfg['order_in_file'][i]], args) for i, value in enumerate(sline)}
+			if line_parser is not None:
+				dicc = line_parser.parse(line)
+			else:
+				sline = line.decode('utf-8', 'ignore').rstrip().split(separator)
+				dicc = parse_line(sline, parse_plan, dates_in_seconds)
 			#geo_stuff
-			if args.geo_precission is not None:
+			if geo_precission is not None:
 				dicc = geo_append(dicc, args)
 
 			#tor_stuff
-			if args.tor_info is not None:
-				aux_tor_check_val = dicc.get(args.tor_info_from, None)
-				try:
-					dicc['tor_info'] = args.tor_info.getTorInfo(aux_tor_check_val, int_ip=args.tor_int_ip)
-					dicc['tor_is_exit_node'] = args.tor_info.isExitNode(aux_tor_check_val, int_ip=args.tor_int_ip)
-					dicc['tor_is_tor_server'] = args.tor_info.isTorServer(aux_tor_check_val, int_ip=args.tor_int_ip)
-				except Exception as e:
-					log.warning('Exception in tor_info module. Might be an invalid IP: |{}| Details: {}'.format(aux_tor_check_val, str(e)))
-					dicc['tor_info'] = 'Invalid IP'
+			if tor_info is not None:
+				dicc = tor_append(dicc, args)
 
-			if args.extra_data is not None:
-				for extra_fieldname in args.extra_data:
-					dicc[extra_fieldname] = parse_property(value, 'keyword')
+			if extra_data is not None:
+				dicc.update(extra_data)
 
-			a = {'_source' : dicc, '_index'  : index, '_type'   : doc_type}
+			a = {'_source' : dicc}
 
-			if args.md5_id:
-				a['_id'] = md5_calc(dicc, cfg['order_in_file'], args)
+			if md5_id:
+				a['_id'] = md5_calc(line.rstrip().split(raw_separator), md5_mask)
 
 			yield a
 		except ValueError as e:
@@ -468,99 +560,300 @@ def typed_iterator(cfg, index, doc_type, args, f):
 			continue
 		except Exception as e:
 			log.warning('Error processing line |{}| ({}). Ignoring line. Details {}'.format(line, ctr, sys.exc_info()[0]))
-			traceback.print_exc(file=sys.stderr)
+			#formatting the traceback of every line is slow if all of them fail
+			if printed_tracebacks < MAX_TRACEBACKS:
+				traceback.print_exc(file=sys.stderr)
+				printed_tracebacks += 1
+				if printed_tracebacks == MAX_TRACEBACKS:
+					log.warning('{} tracebacks printed. The tracebacks of the next errors are omitted.'.format(MAX_TRACEBACKS))
 			continue
 
-def input_generator(cfg, index, doc_type, args, f):
-	ctr = 0
-	for line in f:
-		if ctr == 0 and args.skip_first_line:
-			ctr+=1
-			continue
-		ctr+=1
-		sline = line.rstrip().split(args.separator)
-		try:
-			dicc = {cfg['order_in_file'][i]: value for i, value in enumerate(sline)}
-		except Exception as e:
+def typed_column(column, t, dates_in_seconds):
+	"""Converts a pandas column of strings to a list with the values parsed as parse_property does.
+	Empty, invalid, nan and inf numeric values are converted to None.
+	"""
+	import numpy as np
+	import pandas as pd
+	if t not in PARSE_DISPATCH:
+		column = column.astype(object)
+		return column.where(column.notna(), None).tolist()
+	values = pd.to_numeric(column, errors='coerce').values.astype(np.float64)
+	valid = np.isfinite(values)
+	if t == 'float':
+		result = values.tolist()
+	else:
+		if t == 'date' and dates_in_seconds:
+			values = values*1000
+		fits_int64 = np.abs(np.where(valid, values, 0)) < 2.0**63
+		result = np.where(valid & fits_int64, values, 0).astype(np.int64).tolist()
+		for i in np.flatnonzero(valid & ~fits_int64).tolist():
+			result[i] = int(values[i])
+	if not valid.all():
+		for i in np.flatnonzero(~valid).tolist():
+			result[i] = None
+	return result
+
+def pandas_iterator(cfg, args, f):
+	"""Typed iterator that parses the input with pandas.read_csv in chunks of --bulk lines.
+	The numeric columns are converted in C by pandas and numpy instead of value by value, and the IPs of the chunk are geolocated at once.
+	"""
+	import io, csv
+	import pandas as pd
+	fields = cfg['order_in_file']
+	prop_types = [cfg['properties'][field] for field in fields]
+	dates_in_seconds = args.dates_in_seconds
+	geo_precission = args.geo_precission
+	tor_info = args.tor_info
+	extra_data = args.extra_data
+	#IPs in dot-decimal notation are converted and searched by chunk with get_geodata_batch
+	batch_geo = geo_precission == 'ip' and not args.geo_int_ip
+	if args.skip_first_line:
+		next(f, None)
+	text_f = io.TextIOWrapper(f, encoding='utf-8', errors='ignore')
+	#values are read as strings and then converted by typed_column
+	read_csv_kwargs = dict(header=None, names=fields, index_col=False, dtype=str, keep_default_na=False, quoting=csv.QUOTE_NONE, chunksize=args.bulk)
+	if len(args.separator) == 1:
+		read_csv_kwargs['sep'] = args.separator
+	else:
+		read_csv_kwargs['sep'] = re.escape(args.separator)
+		read_csv_kwargs['engine'] = 'python'
+	try:
+		reader = pd.read_csv(text_f, on_bad_lines='warn', **read_csv_kwargs)
+	except TypeError: #pandas < 1.3
+		reader = pd.read_csv(text_f, error_bad_lines=False, warn_bad_lines=True, **read_csv_kwargs)
+	for chunk in reader:
+		columns = [typed_column(chunk[field], t, dates_in_seconds) for field, t in zip(fields, prop_types)]
+		if batch_geo:
+			geo_results = args.geodb.get_geodata_batch(columns[fields.index(args.geo_column_ip)]) if args.geo_column_ip in fields else [None]*len(chunk)
+		for i, values in enumerate(zip(*columns)):
+			dicc = dict(zip(fields, values))
+			if batch_geo:
+				dicc = add_geo_data(dicc, geo_results[i])
+			elif geo_precission is not None:
+				dicc = geo_append(dicc, args)
+			if tor_info is not None:
+				dicc = tor_append(dicc, args)
+			if extra_data is not None:
+				dicc.update(extra_data)
+			yield {'_source' : dicc}
+
+def input_generator(cfg, args, f):
+	md5_mask = get_md5_mask(cfg['order_in_file'], args)
+	raw_separator = args.separator.encode('utf-8')
+	#local copies of the values used in the loop
+	fields = cfg['order_in_file']
+	n_fields = len(fields)
+	#str.split with a single character separator uses the fast path of CPython, longer separators are also supported
+	separator = args.separator
+	skip_first_line = args.skip_first_line
+	date_fields = args.date_fields if args.dates_in_seconds else []
+	md5_id = args.md5_id
+	geo_precission = args.geo_precission
+	tor_info = args.tor_info
+	extra_data = args.extra_data
+	dumps = json_dumps
+	if skip_first_line:
+		next(f, None)
+	for ctr, line in enumerate(f, 2 if skip_first_line else 1):
+		sline = line.decode('utf-8', 'ignore').rstrip().split(separator)
+		if len(sline) > n_fields:
 			log.warning('Error processing line {}. Continuing...'.format(ctr))
 			continue
+		dicc = dict(zip(fields, sline))
 		#geo_stuff
-		if args.geo_precission is not None:
+		if geo_precission is not None:
 			dicc = geo_append(dicc, args)
 		#tor_stuff
-		if args.tor_info is not None:
-			aux_tor_check_val = dicc.get(args.tor_info_from, None)
-			try:
-				dicc['tor_info'] = args.tor_info.getTorInfo(aux_tor_check_val, int_ip=args.tor_int_ip)
-				dicc['tor_is_exit_node'] = args.tor_info.isExitNode(aux_tor_check_val, int_ip=args.tor_int_ip)
-				dicc['tor_is_tor_server'] = args.tor_info.isTorServer(aux_tor_check_val, int_ip=args.tor_int_ip)
-			except Exception as e:
-				log.warning('Exception in tor_info module. Might be an invalid IP: |{}| Details: {}'.format(aux_tor_check_val, str(e)))
-				dicc['tor_info'] = 'Invalid IP'
-		if args.extra_data is not None:
-			for extra_fieldname in args.extra_data:
-				dicc[extra_fieldname] = args.extra_data[extra_fieldname]
-
-		if args.dates_in_seconds:
-			for date_field in args.date_fields:
-				if date_field in dicc:
-					dicc[date_field] = dicc[date_field]+'000'
-
-				if es_dsl_version >= (6, 0, 0):
-					# changed for elastic 6.x:
-					a = {'_source': dicc, '_index': index, '_type': 'doc'}
-				else:
-					a = {'_source' : dicc, '_index'  : index, '_type'   : doc_type}
-		if args.md5_id:
-			a['_id'] = md5_calc(dicc, cfg['order_in_file'], args)
+		if tor_info is not None:
+			dicc = tor_append(dicc, args)
+		if extra_data is not None:
+			dicc.update(extra_data)
+
+		for date_field in date_fields:
+			if date_field in dicc:
+				dicc[date_field] = dicc[date_field]+'000'
 
-		a['_source'] = json.dumps(a['_source'])
+		a = {'_source' : dicc}
+		if md5_id:
+			a['_id'] = md5_calc(line.rstrip().split(raw_separator), md5_mask)
+
+		a['_source'] = dumps(dicc)
 		yield a
 
 def dummy_iterator(n=100000):
-	j_element = {'_source': json.dumps({u'timestamp': '1509750000000', u'geo': '52.5720661, 52.5720661', u'ip': '192.168.1.1', u'name': 'PotatoFriend', u'description': 'This is a potato and it is your friend', u'age': '20', u'size': '201.1'}), '_index': 'patata', '_type': 'my_potato'}
-	for i in xrange(n):
+	j_element = {'_source': json.dumps({u'timestamp': '1509750000000', u'geo': '52.5720661, 52.5720661', u'ip': '192.168.1.1', u'name': 'PotatoFriend', u'description': 'This is a potato and it is your friend', u'age': '20', u'size': '201.1'})}
+	for i in range(n):
 		yield j_element
 
+def producer_t(documents, document_queues, batch_size, errors):
+	"""Consumes the documents iterator in its own thread and puts the documents in the queues in lists of batch_size elements. None is put at the end of each queue.
+	With several queues, the documents with _id always go to the same queue (by the hash of the _id) and the rest are distributed in round robin by batches.
+	An exception reading the documents is appended to errors so the main thread can fail the import.
+	"""
+	n_queues = len(document_queues)
+	batches = [[] for _ in range(n_queues)]
+	next_queue = 0
+	try:
+		for document in documents:
+			_id = document.get('_id')
+			shard = next_queue if _id is None or n_queues == 1 else hash(_id) % n_queues
+			batch = batches[shard]
+			batch.append(document)
+			if len(batch) == batch_size:
+				document_queues[shard].put(batch)
+				batches[shard] = []
+				if _id is None:
+					next_queue = (next_queue + 1) % n_queues
+	except Exception as e:
+		log.error('Error reading the documents. Details: {}'.format(str(e)))
+		traceback.print_exc(file=sys.stderr)
+		errors.append(e)
+	finally:
+		for document_queue, batch in zip(document_queues, batches):
+			if batch:
+				document_queue.put(batch)
+			document_queue.put(None)
+
+def drain(document_queue):
+	"""Yields the documents put in the queue by producer_t until None is found."""
+	while True:
+		batch = document_queue.get()
+		if batch is None:
+			return
+		for document in batch:
+			yield document
+
+def get_bulk_kwargs(args):
+	"""Returns the keyword arguments of the bulk helper selected with --bulk_mode."""
+	kwargs = {'raise_on_exception': args.raise_on_exception, 'chunk_size': args.bulk, 'max_chunk_bytes': args.max_chunk_bytes, 'raise_on_error': args.raise_on_error}
+	if args.bulk_mode == 'parallel':
+		kwargs['thread_count'] = args.threads
+		kwargs['queue_size'] = args.queue
+	return kwargs
+
+def bulk_index(es, actions, bulk_mode, bulk_kwargs):
+	"""Indexes the actions with streaming_bulk or parallel_bulk.
+	:return: An iterator of (ok, item) tuples, one per action.
+	"""
+	if bulk_mode == 'streaming':
+		return helpers.streaming_bulk(es, actions, **bulk_kwargs)
+	return helpers.parallel_bulk(es, actions, **bulk_kwargs)
+
+def bulk_worker(node, connection_kwargs, bulk_mode, bulk_kwargs, document_queue, result_queue):
+	"""Indexes the documents of document_queue with its own elasticsearch client. Used as the target of the --processes processes.
+	Puts in result_queue a (success, failed) tuple every chunk_size results and, when it finishes, None or the message of the error that stopped it.
+	"""
+	signal.signal(signal.SIGINT, signal.SIG_IGN) #Ctrl+C is handled by the main process, which terminates the workers
+	chunk_size = bulk_kwargs['chunk_size']
+	success = 0; failed = 0
+	error = None
+	try:
+		es = Elasticsearch(node, **connection_kwargs)
+		for ok, item in bulk_index(es, drain(document_queue), bulk_mode, bulk_kwargs):
+			if ok:
+				success+=1
+			else:
+				failed+=1
+				log.debug('Failed document: {}'.format(item))
+			if success + failed == chunk_size:
+				result_queue.put((success, failed))
+				success = 0; failed = 0
+	except Exception as e:
+		#like the exceptions of the bulk helpers in a single process (--raise_on_error, --raise_on_exception), the error aborts the import
+		log.error('Error in the bulk process {}. Details: {}'.format(os.getpid(), str(e)))
+		error = 'The bulk process {} failed.'.format(os.getpid())
+	finally:
+		result_queue.put((success, failed))
+		result_queue.put(error)
+
+def drain_results(result_queue, workers):
+	"""Yields the (success, failed) tuples put by the bulk_worker processes until all of them have finished.
+	Raises RuntimeError if a process puts an error or dies, since a dead process does not put its None in result_queue and stops reading its documents.
+	"""
+	finished = 0
+	while finished < len(workers):
+		try:
+			result = result_queue.get(timeout=WORKER_CHECK_INTERVAL)
+		except queue.Empty:
+			for worker in workers:
+				if worker.exitcode not in (None, 0):
+					raise RuntimeError('The bulk process {} died with exit code {}.'.format(worker.name, worker.exitcode))
+			continue
+		if result is None:
+			finished+=1
+		elif isinstance(result, str):
+			raise RuntimeError(result)
+		else:
+			yield result
+
+def disable_refresh(es, index):
+	"""Disables the refresh of the index during the bulk indexing.
+	:return: The previous refresh_interval of the index, or the elasticsearch default (1s) if it was not set.
+	"""
+	previous = '1s'
+	settings = es.indices.get_settings(index=index, name='index.refresh_interval')
+	for index_settings in settings.values():
+		previous = index_settings.get('settings', {}).get('index', {}).get('refresh_interval', previous)
+	es.indices.put_settings(index=index, body={'index': {'refresh_interval': '-1'}})
+	log.debug('Refresh disabled for index {}. Previous refresh_interval: {}'.format(index, previous))
+	return previous
+
+def restore_refresh(es, index, refresh_interval):
+	es.indices.put_settings(index=index, body={'index': {'refresh_interval': refresh_interval}})
+	log.debug('Refresh interval of index {} restored to {}'.format(index, refresh_interval))
+
 def progress_t(threadname, stop_event):
-	global start_indexing, index_success, index_failed, index_relative_ctr, failed_items
+	"""Logs the progress every PROGRESS_INTERVAL seconds, with the average speed and the speed since the last log line.
+	The indexing loop only updates the counters, so the cost of the progress does not depend on the number of documents.
+	"""
+	global start_indexing, index_success, index_failed, failed_items
 	prev_value = 0
+	prev_time = start_indexing
 	while(not stop_event.is_set()):
-		stop_event.wait(2)
+		stop_event.wait(PROGRESS_INTERVAL)
 		temp_abs_ctr = index_success+index_failed
 		if prev_value != temp_abs_ctr:
-			index_relative_ctr = 0
-			prev_value = temp_abs_ctr
-			lap_elapsed = time.time() - start_indexing
+			now = time.monotonic()
+			lap_elapsed = now - start_indexing
 			lap_speed = temp_abs_ctr/float(lap_elapsed)
-			log.info('Success: {}, Failed: {}. Elapsed: {:.4f} (sec.). Speed: {:.4f} (reg/s)'.format(index_success, index_failed, lap_elapsed, lap_speed))
-			if index_failed:
-				log.debug('Failed lines: {}'.format(failed_items))
+			current_speed = (temp_abs_ctr - prev_value)/float(now - prev_time)
+			prev_value = temp_abs_ctr
+			prev_time = now
+			log.info('Success: {}, Failed: {}. Elapsed: {:.4f} (sec.). Speed: {:.4f} (reg/s). Current speed: {:.4f} (reg/s)'.format(index_success, index_failed, lap_elapsed, lap_speed, current_speed))
+			if failed_items:
+				log.debug('Failed lines: {}'.format(failed_items.tolist()))
 
 if __name__ == '__main__':
 	#GLOBAL VARIABLES FOR progress_t
-	index_failed = -1; index_success = -1; start_indexing=0; index_relative_ctr=0; failed_items = []
+	index_failed = -1; index_success = -1; start_indexing=0; failed_items = array('Q')
 	#END OF GLOBAL VARIABLES
 
 	#load parameters
 	args = parse_args()
 
-	if args.utf8:
-		if sys.version_info < (3,0,0):
-			reload(sys)
-			sys.setdefaultencoding('utf8')
-
 	#load cfg file
 	try:
 		log.debug('Loading cfg file {}'.format(args.cfg))
-		cfg = json.load(open(args.cfg))
+		with open(args.cfg) as cfg_f:
+			cfg = json.load(cfg_f)
 	except ValueError as e:
 		log.error("Invalid JSON format. Please, check the format (commas, lists etc.) Message was: {}".format(str(e)))
 		sys.exit(1)
 
 	pid = os.getpid()
+	workers = [] #processes of --processes
+	disabled_refresh = [] #(es, index, previous_refresh_interval) while the refresh of the index is disabled
 	def signal_handler(signal, frame):
 			log.error('You pressed Ctrl+C! Aborting execution.')
+			#the workers ignore SIGINT and would stay blocked reading their queues after the main process is killed
+			for worker in workers:
+				worker.terminate()
+			#the finally of the indexing does not run after the kill
+			for es_client, refresh_index, refresh_interval in disabled_refresh:
+				try:
+					restore_refresh(es_client, refresh_index, refresh_interval)
+				except Exception as e:
+					log.error('The refresh_interval of index {} could not be restored to {}. Details: {}'.format(refresh_index, refresh_interval, str(e)))
 			os.kill(pid, 9)
 
 	log.debug('Registering signal handler')
@@ -577,14 +870,14 @@ if __name__ == '__main__':
 
 	index = cfg['meta']['index'] if args.index is None else args.index
 	doc_type = str(cfg['meta']['type']) if args.type is None else args.type
+	#the index and type are sent once per bulk request instead of in every action
+	bulk_kwargs = {'index': index, 'doc_type': doc_type}
 
 	if not args.test_processing_speed:
 
 		log.debug('Trying Elasticsearch Connection')
-		if args.user is None:
-			es = Elasticsearch(args.node, timeout=args.timeout, port=args.port)
-		else:
-			es = Elasticsearch(args.node, timeout=args.timeout, port=args.port, http_auth=(args.user, args.password))
+		connection_kwargs = get_connection_kwargs(args)
+		es = Elasticsearch(args.node, **connection_kwargs)
 		full_version = es.info()['version']['number']
 		es_version = int(full_version.split('.')[0])
 
@@ -600,10 +893,7 @@ if __name__ == '__main__':
 		log.debug('Creating doc class')
 		DocClass = create_doc_class(cfg, doc_type, args)
 		#connection to elasticsearch
-		if args.user is None:
-			connections.create_connection(hosts=[args.node], timeout=args.timeout, port=args.port) #connection for api
-		else:
-			connections.create_connection(hosts=[args.node], timeout=args.timeout, port=args.port, http_auth=(args.user, args.password)) #connection for api
+		connections.create_connection(hosts=[args.node], **connection_kwargs) #connection for api
 
 		#delete before doing anything else
 		if args.delete:
@@ -629,70 +919,127 @@ if __name__ == '__main__':
 	try:
 		if args.input != '-':
 			log.debug('Opening file {}'.format(args.input))
-			f = codecs.open(args.input, buffering=1, encoding='utf-8', errors='ignore')
+			f = open_input(args.input)
 		else:
-			f = sys.stdin
+			f = sys.stdin.buffer if hasattr(sys.stdin, 'buffer') else sys.stdin
 	except IOError as e:
 		log.error('Error with the input file |{}|, Details: {}.'.format(args.input, sys.exc_info()[0]))
 		sys.exit()
 
-	if args.typed_iterator:
+	if args.pandas_iterator and args.md5_id:
+		log.warning('--pandas_iterator is not compatible with --md5_id. Using typed_iterator instead.')
+		args.typed_iterator = True
+	if args.pandas_iterator and not args.md5_id:
+		log.info('Using pandas_iterator.')
+		documents = pandas_iterator(cfg, args, f)
+	elif args.typed_iterator:
 		log.info('Using typed_iterator. Performance might be affected.')
-		documents = typed_iterator(cfg, index, doc_type, args, f)
+		documents = typed_iterator(cfg, args, f)
 	else:
-		documents = input_generator(cfg, index, doc_type, args, f)
+		documents = input_generator(cfg, args, f)
 
 	if args.test_processing_speed:
 		log.debug('Test processing speed')
-		start = time.time()
+		start = time.monotonic()
 		test_abs_ctr = 0
-		for d in documents:
-			test_abs_ctr+=1
-			if test_abs_ctr%1000 == 0:
+		for test_abs_ctr, d in enumerate(documents, 1):
+			#cheaper than a modulo, logs every 8192 documents
+			if test_abs_ctr & 0x1FFF == 0:
 				log.debug('Processed: {}'.format(test_abs_ctr))
 		log.debug('Processed: {}'.format(test_abs_ctr))
-		end = time.time()
+		end = time.monotonic()
 		elapsed = end - start
 		speed = test_abs_ctr/float(elapsed)
 		log.info('Success: {} Elapsed: {:.4f} (sec.). Speed: {:.4f} (reg/s)'.format(test_abs_ctr, elapsed, speed))
 		sys.exit()
 
-	start_indexing = time.time()
-	ret = helpers.parallel_bulk(es, documents, raise_on_exception=args.raise_on_exception, thread_count=args.threads, queue_size=args.queue, chunk_size=args.bulk, raise_on_error=args.raise_on_error)
-
+	#refreshing while indexing creates many small segments
+	previous_refresh_interval = disable_refresh(es, index)
+	disabled_refresh.append((es, index, previous_refresh_interval))
 	progress_t_stop = None
-	if not args.noprogress:
-		progress_t_stop = Event()
-		progress_thread = Thread( target=progress_t, args=("ProgressT", progress_t_stop) )
-		progress_thread.start()
-	index_failed = 0; index_success = 0; abs_ctr=0; index_relative_ctr=0
-	log.debug('Iterating documents')
-	for ok, item in ret:
-		abs_ctr+=1
-		index_relative_ctr+=1
-		#STATS
-		if ok:
-			index_success+=1
+	workers_failed = False
+	try:
+		start_indexing = time.monotonic()
+		helper_kwargs = get_bulk_kwargs(args)
+		helper_kwargs.update(bulk_kwargs)
+		if args.processes > 1:
+			#each process has its own client and connection pool and serializes its bulk requests out of the GIL of this process
+			import multiprocessing
+			document_queues = [multiprocessing.Queue(maxsize=args.queue) for _ in range(args.processes)]
+			result_queue = multiprocessing.Queue()
+			for i, document_queue in enumerate(document_queues):
+				worker = multiprocessing.Process(target=bulk_worker, args=(args.node, connection_kwargs, args.bulk_mode, helper_kwargs, document_queue, result_queue), name='BulkP-{}'.format(i))
+				worker.daemon = True
+				worker.start()
+				workers.append(worker)
+			log.info('Indexing with {} processes.'.format(args.processes))
 		else:
-			index_failed+=1
-			failed_items.append(abs_ctr)
-			#better here than in progress_t because less executions are made
-			if len(failed_items) > 1000:
-				log.error('More than 10K errors, clearing error list.')
-				log.error('There were some errors during the process: Success: {0}, Failed: {1}'.format(index_success, index_failed))
-				log.error('These were the errors in lines: {}'.format(failed_items))
-				failed_items = []
-	if not args.noprogress:
-		progress_t_stop.set()
-		progress_thread.join()
-	end = time.time()
+			document_queues = [queue.Queue(maxsize=args.queue)]
+		#the documents are produced in another thread so parsing overlaps with the bulk requests
+		producer_errors = []
+		producer_thread = Thread(target=producer_t, args=(documents, document_queues, args.bulk, producer_errors), name='ProducerT')
+		producer_thread.daemon = True
+		producer_thread.start()
+
+		if not args.noprogress:
+			progress_t_stop = Event()
+			progress_thread = Thread( target=progress_t, args=("ProgressT", progress_t_stop) )
+			progress_thread.start()
+		index_failed = 0; index_success = 0; abs_ctr=0
+		log.debug('Iterating documents')
+		if workers:
+			try:
+				for success, failed in drain_results(result_queue, workers):
+					index_success+=success
+					index_failed+=failed
+			except RuntimeError as e:
+				log.error('{} Aborting execution.'.format(str(e)))
+				for worker in workers:
+					worker.terminate()
+				workers_failed = True
+			abs_ctr = index_success+index_failed
+			for worker in workers:
+				worker.join()
+		else:
+			ret = bulk_index(es, drain(document_queues[0]), args.bulk_mode, helper_kwargs)
+			for abs_ctr, (ok, item) in enumerate(ret, 1):
+				#STATS
+				if ok:
+					index_success+=1
+				else:
+					index_failed+=1
+					failed_items.append(abs_ctr)
+					#better here than in progress_t because less executions are made
+					if len(failed_items) >= MAX_FAILED_ITEMS:
+						log.error('{} errors reached, clearing error list.'.format(MAX_FAILED_ITEMS))
+						log.error('There were some errors during the process: Success: {0}, Failed: {1}'.format(index_success, index_failed))
+						log.error('These were the errors in lines: {}'.format(failed_items.tolist()))
+						failed_items = array('Q')
+		if not workers_failed:
+			producer_thread.join()
+	finally:
+		del disabled_refresh[:]
+		restore_refresh(es, index, previous_refresh_interval)
+		if progress_t_stop is not None:
+			progress_t_stop.set()
+			progress_thread.join()
+	if workers_failed:
+		#the producer thread is blocked writing the queue of the stopped process or reading the input, the interpreter can not shut down with it
+		os._exit(1)
+	end = time.monotonic()
 	elapsed = end - start_indexing
 	speed = abs_ctr/float(elapsed)
 	log.info('Success: {}, Failed: {}. Elapsed: {:.4f} (sec.). Speed: {:.4f} (reg/s)'.format(index_success, index_failed, elapsed, speed))
 
 	if index_failed > 0:
 		log.error('There were some errors during the process: Success: {0}, Failed: {1}'.format(index_success, index_failed))
-		log.error('These were the errors in lines: {}'.format(failed_items))
+		#the lines are not tracked with --processes
+		if failed_items:
+			log.error('These were the errors in lines: {}'.format(failed_items.tolist()))
+
+	if producer_errors:
+		log.error('The import was aborted because the documents could not be read.')
+		sys.exit(1)
 
 	if args.refresh:
 		es.indices.refresh(index=index)
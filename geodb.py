@@ -1,26 +1,73 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
-import sqlite3, argparse, os, logging, os.path, gzip, sys, gc, bisect
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
+import sqlite3, argparse, os, logging, os.path, gzip, sys, gc, threading
+from collections import OrderedDict
 import numpy as np
-from shapely.geometry import MultiPoint
 from argparse import RawTextHelpFormatter
-from shapely.geometry import MultiPoint
 from net_utils import *
+from geodb_kernels import ip2int_batch, int_batch, lookup_indices, NOT_FOUND
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+	PYARROW_AVAILABLE = True
+except ImportError:
+	PYARROW_AVAILABLE = False
 from debug_utils import log_rss_memory_usage, get_script_path, timeit
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+#sqlite settings of every connection
+SQLITE_CACHE_SIZE = -64*1024 # in KiB when negative, 64 MiB of page cache
+SQLITE_MMAP_SIZE = 2*1024**3 # maximum size of the memory map, the populated databases map their whole file up to this size
+SQLITE_JOURNAL_SIZE_LIMIT = 64*1024**2
+CSV_CHUNK_SIZE = 50000 # rows of the csv files inserted at once in the databases
+PARQUET_TYPES = {int: 'int64', float: 'float64', str: 'string'} # column types of the parquet copies of the csv files
+SQL_TYPES = {int: 'INTEGER', float: 'REAL', str: 'TEXT'} # column types of the tables created from the csv files
+POINTS_FETCH_SIZE = 1000 # rows of a query read as tuples, queries with more rows read the latitude and longitude of all the rows in a second query
+IP_DTYPE = np.uint32 # IPv4 addresses fit in 32 bits, so the binary searches read half the memory of int64
+
+def _apply_pragmas(conn, bulk_load=False):
+	"""Sets the pragmas used in every sqlite connection.
+	The WAL journal with synchronous=NORMAL avoids a fsync per commit, and temporary tables and indices are kept in memory.
+	:param conn: sqlite3 connection.
+	:param bulk_load: If True, the database is also locked in exclusive mode and not synced while it is populated.
+	"""
+	conn.execute('pragma journal_mode = wal')
+	conn.execute('pragma synchronous = normal')
+	conn.execute('pragma temp_store = memory')
+	conn.execute('pragma cache_size = {}'.format(SQLITE_CACHE_SIZE))
+	conn.execute('pragma mmap_size = {}'.format(SQLITE_MMAP_SIZE))
+	conn.execute('pragma journal_size_limit = {}'.format(SQLITE_JOURNAL_SIZE_LIMIT))
+	if bulk_load:
+		conn.execute('pragma locking_mode = exclusive')
+		conn.execute('pragma synchronous = off')
+
+def _set_query_only(conn, db_path):
+	"""Sizes the memory map to the database file and makes the connection read only. Called once the database is populated and indexed.
+	With the whole file mapped the reads do not copy the pages from the OS page cache.
+	:param conn: sqlite3 connection.
+	:param str db_path: Path of the database file.
+	"""
+	conn.execute('pragma mmap_size = {}'.format(min(int(os.path.getsize(db_path)*1.1), SQLITE_MMAP_SIZE)))
+	conn.execute('pragma query_only = 1')
+
+def _representative_point(points):
+	"""Computes the representative point of many results as the median of their latitudes and longitudes.
+	The median is not moved by a few distant points, like the overseas regions of a country.
+	:param list points: Tuples (latitude, longitude).
+	:return: Tuple (lat, lon).
+	"""
+	points = np.array(points, dtype=np.float64)
+	return float(np.median(points[:, 0])), float(np.median(points[:, 1]))
+
 class GeoDatabase_Base(object):
 	"""A base class with common methods.
-	Child classes should implement _get_geodata
+	Child classes should implement _get_geodata_single and _get_geodata_multi
 	"""
+	unique_columns = [] # columns with a different value in each row
 
-	def __init__(self, name, original_db_path, db_path, names=[], types={}, separator=',', index_columns=[], update=False, compression='infer', debug=False):
+	def __init__(self, name, original_db_path, db_path, names=[], types={}, separator=',', index_columns=[], update=False, compression='infer', debug=False, cache_size=100000):
 		"""Creates a GeoDatabase_Base object
 
 		:param str name: Name of the table in the database.
@@ -32,6 +79,7 @@ class GeoDatabase_Base(object):
 		:param index_columns: List of indices to create by using the column names.
 		:param update: If True, removes the previous database file and regenerates the database.
 		:param compression: If the csv file is compressed specify the kind of compression. {'infer', 'gzip', 'bz2', 'zip', 'xz', None} See https://pandas.pydata.org/pandas-docs/stable/generated/pandas.read_csv.html.
+		:param int cache_size: Maximum number of results in the result cache. The least recently used results are removed first.
 		:return: A GeoDatabase_Base object.
 		"""
 		self.name = name
@@ -45,26 +93,100 @@ class GeoDatabase_Base(object):
 		self.indices = []
 		self.index_columns = index_columns
 		self.update = update
+		self._row_shapes = {}
+		self._last_row_shape = (None, None)
 		self._load_database()
-		self.cursor = self.conn.cursor()
-		self._results_cache = {}
+		self._local = threading.local()
+		self._set_thread_connection(self.conn)
+		self._points_queries = {}
+		self._results_cache = OrderedDict()
+		self._cache_lock = threading.Lock()
+		self._cache_size = cache_size
+		self._queries = {}
+
+	def _set_thread_connection(self, conn):
+		"""Stores the connection of the current thread and its cursors."""
+		self._local.conn = conn
+		self._local.cursor = conn.cursor()
+		#returns the rows as tuples, only the first row of the queries is converted with _dict_factory
+		self._local.tuple_cursor = conn.cursor()
+		self._local.tuple_cursor.row_factory = None
+
+	def _thread_local(self):
+		"""Returns the connection and cursors of the current thread. The threads other than the one that loaded the database open their own
+		read only connection the first time they query, so the queries of many threads run in parallel instead of sharing a connection.
+		"""
+		local = self._local
+		if not hasattr(local, 'conn'):
+			logger.debug('Opening connection to {} for thread {}.'.format(self.db_path, threading.current_thread().name))
+			conn = sqlite3.connect(self.db_path)
+			_apply_pragmas(conn)
+			_set_query_only(conn, self.db_path)
+			conn.row_factory = self._dict_factory
+			self._set_thread_connection(conn)
+		return local
+
+	@property
+	def cursor(self):
+		"""Cursor of the current thread."""
+		return self._thread_local().cursor
+
+	@property
+	def _tuple_cursor(self):
+		"""Cursor of the current thread that returns the rows as tuples."""
+		return self._thread_local().tuple_cursor
+
+	def _row_shape(self, description):
+		"""Returns the converters of the columns of a cursor description. They are built once for each description.
+		:param tuple description: cursor.description of the query.
+		:return: Tuple of (index, column, type, is_numeric) for every column but the index.
+		"""
+		#the cursor returns the same description object for every row of a query, so the identity check avoids hashing it
+		last_description, shape = self._last_row_shape
+		if description is last_description:
+			return shape
+		shape = self._row_shapes.get(description)
+		if shape is None:
+			shape = tuple((idx, col[0], self.types[col[0]], self.types[col[0]] in [int, float]) for idx, col in enumerate(description) if col[0] != 'index')
+			self._row_shapes[description] = shape
+		self._last_row_shape = (description, shape)
+		return shape
 
 	def _dict_factory(self, cursor, row):
 		d = {}
-		for idx, col, in enumerate(cursor.description):
-			k = col[0]
-			if k == 'index':
-				continue
-			f = self.types[k]
-			if f in [int, float]:
-				try:
-					d[k] = f(row[idx])
-				except:
-					continue
+		for idx, k, f, numeric in self._row_shape(cursor.description):
+			value = row[idx]
+			if numeric:
+				#NULL values and the empty strings of the text columns of the FTS5 tables can not be converted and are left out
+				if value is not None and value != '':
+					d[k] = f(value)
 			else:
-				d[k] = f(row[idx])
+				d[k] = f(value)
 		return d
 
+	def _select_equals(self, columns, multi_op='AND'):
+		"""Returns a SELECT query comparing each column with a ? parameter, so the values are bound instead of formatted into the query.
+		The queries are built once for each list of columns, and the same query string lets sqlite reuse its prepared statement.
+		Queries that match a column of self.unique_columns return one row at most, so they are limited to 1.
+		:param list columns: Column names. They can not be parameters, so they must be in self.names.
+		:param str multi_op: AND or OR.
+		:return: String with the query.
+		"""
+		key = (tuple(columns), multi_op)
+		query = self._queries.get(key)
+		if query is None:
+			for column in columns:
+				if column not in self.names:
+					raise ValueError('Unknown column |{}| in {}.'.format(column, self.name))
+			if multi_op not in ['AND', 'OR']:
+				raise ValueError('Invalid operator |{}|.'.format(multi_op))
+			op = ' {} '.format(multi_op)
+			query = 'SELECT * FROM {} WHERE {}'.format(self.name, op.join(['"{}" = ?'.format(column) for column in columns]))
+			if multi_op == 'AND' and any(column in self.unique_columns for column in columns):
+				query += ' LIMIT 1'
+			self._queries[key] = query
+		return query
+
 	def _get_indices(self):
 		"""Loads the list of indices in self.indices variable and returns it.
 		return: A list of strings with the indices names.
@@ -107,41 +229,77 @@ class GeoDatabase_Base(object):
 				logging.warning('Database {} does not exist.'.format(self.db_path))
 				pass
 			#LOADING DATABASE FROM FILE
+			#the csv file is read and inserted in chunks so the whole file is never in memory
 			log_rss_memory_usage('Before reading csv database.')
-			df = pd.read_csv(self.original_db_path, sep=self.separator, names=self.names, dtype=self.types, compression=self.compression, keep_default_na=False, na_values=['-1.#IND', '1.#QNAN', '1.#IND', '-1.#QNAN', '#N/A N/A', '#N/A', 'N/A', 'n/a', '#NA', 'NULL', 'null', 'NaN', '-NaN', 'nan', '-nan', ''], encoding='utf-8')
-			df.columns = [column.lower() for column in df.columns]
-			log_rss_memory_usage('After reading csv database.')
-			# The original file must be in uppercase, this avoids using the following loop whichs some how uses a lot of memory
-			# for column, t in df.dtypes.iteritems():
-			# 	if t == np.dtype('O'):
-			# 		df[column] = df[column].str.upper()
-			self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-			log_rss_memory_usage('Before to_sql.')
-			df.to_sql(self.name, self.conn, if_exists='replace', chunksize=1000)
-			log_rss_memory_usage('After to_sql.')
-			del df
-			gc.collect()
+			reader = self._read_original_db(CSV_CHUNK_SIZE)
+			# The original file must be in uppercase, this avoids converting the strings to uppercase
+			self.conn = sqlite3.connect(self.db_path)
+			_apply_pragmas(self.conn, bulk_load=True)
+			self.conn.execute('CREATE TABLE {} ({})'.format(self.name, ', '.join(['"{}" {}'.format(column.lower(), SQL_TYPES.get(self.types.get(column), '')) for column in self.names])))
+			insert = 'INSERT INTO {} VALUES ({})'.format(self.name, ', '.join(['?']*len(self.names)))
+			#a single transaction for all the chunks. The columns are converted to python lists, the NaN values are stored as NULL by sqlite
+			with self.conn:
+				for chunk in reader:
+					self.conn.executemany(insert, zip(*[chunk[column].tolist() for column in chunk.columns]))
+			self.conn.execute('pragma locking_mode = normal')
+			self.conn.execute('pragma synchronous = normal')
 			log_rss_memory_usage('After creating sql database.')
 			logger.info('Database {} created.'.format(self.db_path))
 		else:
-			self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-			# Open database in autocommit mode by setting isolation_level to None.
-			# Set journal mode to WAL.
-			self.conn.execute('pragma journal_mode=wal')
-			self.conn.execute('pragma cache_size = {}'.format(500*1000))
-			self.conn.execute('pragma mmap_size = {}'.format(500*10**6))
-			self.conn.execute('pragma synchronous = 0')
+			self.conn = sqlite3.connect(self.db_path)
+			_apply_pragmas(self.conn)
 		self._get_indices()
 		self._create_indices(self.index_columns)
+		_set_query_only(self.conn, self.db_path)
 		self.conn.row_factory = self._dict_factory
 		log_rss_memory_usage('Finished _load_database function.')
 		return self.conn
 
+	def _read_original_db(self, chunksize=None):
+		"""Reads the csv file with the data to populate the database.
+		If pyarrow is installed, regenerating the database (self.update) writes a parquet copy of the csv file next to the database, and the next reads use the copy
+		while it is newer than the csv file and was written with the same columns and types, so the csv file is not parsed again.
+		:param int chunksize: Number of rows of each DataFrame, or None to read the whole file in one DataFrame.
+		:return: Generator of DataFrames with the columns in self.names.
+		"""
+		parquet_path = os.path.splitext(self.db_path)[0] + '.parquet'
+		if PYARROW_AVAILABLE:
+			#the names of the python types are stored in the metadata of the copy, the parquet types do not tell apart all of them
+			schema = pa.schema([(column, PARQUET_TYPES.get(self.types.get(column), 'string')) for column in self.names],
+				metadata={'geodb_types': ','.join(['{}:{}'.format(column, getattr(self.types.get(column), '__name__', '')) for column in self.names])})
+			fresh = os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(self.original_db_path)
+			if fresh and (pq.read_schema(parquet_path).metadata or {}).get(b'geodb_types') == schema.metadata[b'geodb_types']:
+				logger.info('Reading {} instead of {}.'.format(parquet_path, self.original_db_path))
+				if chunksize is None:
+					yield pq.read_table(parquet_path).to_pandas()
+				else:
+					for batch in pq.ParquetFile(parquet_path).iter_batches(batch_size=chunksize):
+						yield batch.to_pandas()
+				return
+		reader = pd.read_csv(self.original_db_path, sep=self.separator, names=self.names, dtype=self.types, compression=self.compression, keep_default_na=False, na_values=['-1.#IND', '1.#QNAN', '1.#IND', '-1.#QNAN', '#N/A N/A', '#N/A', 'N/A', 'n/a', '#NA', 'NULL', 'null', 'NaN', '-NaN', 'nan', '-nan', ''], encoding='utf-8', chunksize=chunksize)
+		if chunksize is None:
+			reader = [reader]
+		#loading the database without update does not write next to it
+		if not PYARROW_AVAILABLE or not self.update:
+			for chunk in reader:
+				yield chunk
+			return
+		#the copy is written to a temporary file, so a partial copy is never used
+		with pq.ParquetWriter(parquet_path + '.tmp', schema, compression='zstd') as writer:
+			for chunk in reader:
+				writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+				yield chunk
+		os.replace(parquet_path + '.tmp', parquet_path)
+		logger.info('Parquet copy {} created.'.format(parquet_path))
+
 	# @timeit
-	def get_geodata(self, *args, **kwargs):
-		"""Queries the database. It checks if the value exists in the result cache and adds the value if it didn't exist before.
-		:param args: mandatory args will be passed to the corresponding self._get_geodata method of each class.
-		:param kwargs: optional args will be passed to the corresponding self._get_geodata method of each class.
+	def get_geodata(self, column, value, *args, **kwargs):
+		"""Queries the database. Calls get_geodata_multi if column is a list of columns and get_geodata_single otherwise.
+		The callers that always query the same kind of columns can call get_geodata_single or get_geodata_multi directly.
+		:param column: Column or list of columns to query.
+		:param value: Value or list of values of the given column/s.
+		:param args: optional args will be passed to get_geodata_multi, like multi_op.
+		:param kwargs: optional args will be passed to get_geodata_single or get_geodata_multi.
 		:return: dictionary with geographical information like (fields may change depeding on the children classses ):
 		{
 			 'place_name': 'MONTERREY',
@@ -153,36 +311,105 @@ class GeoDatabase_Base(object):
 			 'zip_code': '64830'
 		}
 		"""
-		keyargs = tuple((tuple(arg) if type(arg) is list else arg for arg in args))
-		key = keyargs + tuple(kwargs.values())
+		if type(column) is list:
+			return self.get_geodata_multi(column, value, *args, **kwargs)
+		return self.get_geodata_single(column, value, **kwargs)
+
+	def get_geodata_single(self, column, value, **kwargs):
+		"""Queries the database with a column through the result cache. See the _get_geodata_single method of each class.
+		:param str column: Column to query.
+		:param value: Value of the given column.
+		:param kwargs: optional args will be passed to the self._get_geodata_single method of each class.
+		:return: dictionary with geographical information or None.
+		"""
+		key = (column, value) + tuple(kwargs.values())
 		val = self._get_result_from_cache(key)
 		if val is not False:
 			return val
-		val = self._get_geodata(*args, **kwargs)
+		val = self._get_geodata_single(column, value, **kwargs)
 		if val is None:
 			return None
 		self._add_result_to_cache(key, val)
 		return val
 
-	def _get_geodata(self):
-		"""Queries the database. Unimplemented method. See the corresponding method self._get_geodata of each class.
+	def get_geodata_multi(self, columns, values, multi_op='AND'):
+		"""Queries the database with many columns through the result cache. See the _get_geodata_multi method of each class.
+		:param list columns: Columns to query.
+		:param list values: Values of the given columns, of the same length.
+		:param str multi_op: Operator of the query.
+		:return: dictionary with geographical information or None.
+		"""
+		if len(columns) != len(values):
+			return None
+		key = (tuple(columns), tuple(values), multi_op)
+		val = self._get_result_from_cache(key)
+		if val is not False:
+			return val
+		val = self._get_geodata_multi(columns, values, multi_op)
+		if val is None:
+			return None
+		self._add_result_to_cache(key, val)
+		return val
+
+	def _get_geodata_single(self, column, value):
+		"""Queries the database with a column. Unimplemented method. See the corresponding method self._get_geodata_single of each class.
+		:return: dictionary with geographical information like (fields may change depeding on the children classses ):
+		"""
+		pass
+
+	def _get_geodata_multi(self, columns, values, multi_op='AND'):
+		"""Queries the database with many columns. Unimplemented method. See the corresponding method self._get_geodata_multi of each class.
 		:return: dictionary with geographical information like (fields may change depeding on the children classses ):
 		"""
 		pass
 
+	def _query_first(self, query, params):
+		"""Runs a query and returns its first row and the representative point of all the rows.
+		Only the first row is converted to a dictionary, the latitude and longitude of the other rows are read from the tuples.
+		:param str query: Query.
+		:param params: Parameters of the query.
+		:return: Tuple (first row as a dictionary, (lat, lon) or None if there is only one row), or (None, None) if there are no rows.
+		"""
+		cursor = self._tuple_cursor
+		cursor.execute(query, params)
+		row = cursor.fetchone()
+		if row is None:
+			return None, None
+		d = self._dict_factory(cursor, row)
+		rest = cursor.fetchmany(POINTS_FETCH_SIZE)
+		if not rest:
+			return d, None
+		if len(rest) == POINTS_FETCH_SIZE:
+			#many rows, the query is run again reading only their latitude and longitude
+			points_query = self._points_queries.get(query)
+			if points_query is None:
+				points_query = 'SELECT latitude, longitude FROM ({})'.format(query)
+				self._points_queries[query] = points_query
+			return d, _representative_point(cursor.execute(points_query, params).fetchall())
+		columns = [col[0] for col in cursor.description]
+		lat, lon = columns.index('latitude'), columns.index('longitude')
+		return d, _representative_point([(row[lat], row[lon])] + [(r[lat], r[lon]) for r in rest])
+
 	def _get_result_from_cache(self, key):
 		"""Checks if the given key exists in the cache. If so, returns the value.
 		:param key: Key.
 		:return: The cached value if exists or False if not.
 		"""
-		return self._results_cache.get(key, False)
+		with self._cache_lock:
+			val = self._results_cache.get(key, False)
+			if val is not False:
+				self._results_cache.move_to_end(key)
+		return val
 
 	def _add_result_to_cache(self, key, d):
 		"""Adds the key and value d to the cache dictionary.
 		:param key: Key for the dictionary.
 		:param d: Result to add to the cache.
 		"""
-		self._results_cache[key] = d
+		with self._cache_lock:
+			self._results_cache[key] = d
+			if len(self._results_cache) > self._cache_size:
+				self._results_cache.popitem(last=False)
 
 class CountryLevel_GeoDB(GeoDatabase_Base):
 	"""Class child of GeoDatabase_Base.
@@ -201,7 +428,9 @@ class CountryLevel_GeoDB(GeoDatabase_Base):
 	"""
 	names   = ['latitude', 'longitude', 'country_code', 'country_name']
 	types   = {'country_code': str, 'country_name': str, 'latitude': float, 'longitude': float}
+	unique_columns = ['country_code', 'country_name']
 	indices = ['country_code', 'country_name']
+	preloaded_columns = ['country_code', 'country_name'] # columns of the single column queries answered from memory, unique like in sqlite
 	def __init__(self, *args, **kwargs):
 		if 'index_columns' not in kwargs:
 			kwargs['index_columns'] = CountryLevel_GeoDB.indices
@@ -210,11 +439,23 @@ class CountryLevel_GeoDB(GeoDatabase_Base):
 		if 'types' not in kwargs:
 			kwargs['types'] = CountryLevel_GeoDB.types
 		super(CountryLevel_GeoDB, self).__init__(*args, **kwargs)
+		self._preload()
 		logger.debug('CountryLevel_GeoDB DB0 loaded.')
 
-	def _get_geodata(self, column, value, multi_op='AND'):
-		"""Queries the database.
-		:param column: Column to query.
+	def _preload(self):
+		"""Loads the results of the single column queries by country_code and country_name in self._preloaded, so they are answered without sqlite.
+		Both columns are in self.unique_columns, so each value has one row. Like the queries with LIMIT 1, the first row is kept.
+		"""
+		self._preloaded = {column: {} for column in self.preloaded_columns}
+		self.cursor.execute('SELECT * FROM {} ORDER BY rowid'.format(self.name))
+		for row in self.cursor.fetchall():
+			result = self._build_result(dict(row))
+			for column in self.preloaded_columns:
+				self._preloaded[column].setdefault(row[column], result)
+
+	def _get_geodata_single(self, column, value):
+		"""Queries the database. The queries by the preloaded columns are answered from memory.
+		:param str column: Column to query.
 		:param value: Value of the given column. Provide the value in upper case.
 		:return: dictionary with geographical information like:
 		{
@@ -224,29 +465,39 @@ class CountryLevel_GeoDB(GeoDatabase_Base):
 			 'representative_point': {'lat': 37.09024, 'lon': -95.712891}
 		}
 		A representative point is a kind of centroid calculated when there are many. For example, if you query with country_code: US, there are many different entries.
-		The location dictionary would be populated with the first geopoint, and the rerpesentative_point would be calculated using the method representative_point of a shapely.geometry.MultiPoint
-		See https://toblerity.org/shapely/manual.html#object.representative_point
+		The location dictionary would be populated with the first geopoint, and the representative_point would be the median of the latitudes and longitudes of all the geopoints.
 		However, in this database, there should be only one possible entry for each query.
 		"""
-		if type(column) is str:
-			self.cursor.execute('SELECT * FROM {} WHERE {} = "{}"'.format(self.name, column, value))
-		elif type(column) is list and type(value) is list and len(column) == len(value):
-			op = ' {} '.format(multi_op)
-			query = op.join(['"{}" = "{}"'.format(e[0], e[1]) for e in zip(column, value)])
-			query = 'SELECT * FROM {} WHERE {}'.format(self.name, query)
-			self.cursor.execute(query)
+		preloaded = self._preloaded.get(column)
+		if preloaded is not None and value in preloaded:
+			return dict(preloaded[value])
+		return self._query(self._select_equals([column]), (value,))
+
+	def _get_geodata_multi(self, columns, values, multi_op='AND'):
+		"""Queries the database with many columns.
+		:param list columns: Columns to query.
+		:param list values: Values of the given columns. Provide the values in upper case.
+		:param str multi_op: AND or OR.
+		:return: dictionary with geographical information like the one of _get_geodata_single.
+		"""
+		return self._query(self._select_equals(columns, multi_op), values)
 
-		results = self.cursor.fetchall()
-		if results is None or len(results) == 0:
+	def _query(self, query, params):
+		d, representative_point = self._query_first(query, params)
+		if d is None:
 			return None
-		d = results[0]
-		d['location'] = '{},{}'.format(results[0]['latitude'], results[0]['longitude'])
+		return self._build_result(d, representative_point)
+
+	def _build_result(self, d, representative_point=None):
+		"""Builds the result of a query.
+		:param dict d: First row of the query.
+		:param representative_point: Tuple (lat, lon) if the query has more than one row.
+		:return: d with the location and representative_point instead of the latitude and longitude.
+		"""
+		d['location'] = '{},{}'.format(d['latitude'], d['longitude'])
 		d['representative_point'] = d['location']
-		if len(results) > 1:
-			geo_points = [(r['latitude'], r['longitude']) for r in results]
-			geo_points = MultiPoint(geo_points)
-			repr_lat, repr_lon = geo_points.representative_point().coords[0]
-			d['representative_point'] = '{},{}'.format(repr_lat, repr_lon)
+		if representative_point is not None:
+			d['representative_point'] = '{},{}'.format(*representative_point)
 		del d['latitude']
 		del d['longitude']
 		if 'index' in d:
@@ -257,7 +508,9 @@ class ZIPLevel_GeoDB(GeoDatabase_Base):
 	names = ['country_code', 'zip_code', 'place_name', 'admin_name1', 'admin_code1', 'admin_name2', 'admin_code2', 'admin_name3', 'admin_code3', 'latitude', 'longitude', 'accuracy']
 	types = {'country_code': str, 'zip_code': str, 'place_name': str, 'admin_name1': str, 'admin_code1': str, 'admin_name2': str, 'admin_code2': str, 'admin_name3': str, 'admin_code3': str, 'latitude': float, 'longitude': float, 'accuracy': float }
 	indices = []
-	def __init__(self, name, original_db_path, db_path, names=[], types=[], index_columns=[], update=False, debug=False):
+	#columns with codes, queried with equality in a normal table instead of the FTS5 table
+	code_columns = ['country_code', 'admin_code1', 'admin_code2']
+	def __init__(self, name, original_db_path, db_path, names=[], types=[], index_columns=[], update=False, debug=False, cache_size=100000):
 		if len(names) == 0:
 			names = ZIPLevel_GeoDB.names
 		if len(types) == 0:
@@ -267,7 +520,10 @@ class ZIPLevel_GeoDB(GeoDatabase_Base):
 		if not ZIPLevel_GeoDB.check_FTS5_support():
 			logging.error('FTS5 extension not available in your sqlite3 installation. py-sqlite3 version: {}. sqlite3 version: {}. Please, recompile or reinstall sqlite3 modules with FTS5 support.'.format(sqlite3.version, sqlite3.sqlite_version))
 			sys.exit(1)
-		super(ZIPLevel_GeoDB, self).__init__(name, original_db_path, db_path, names=names, types=types, index_columns=index_columns, update=update, debug=debug)
+		super(ZIPLevel_GeoDB, self).__init__(name, original_db_path, db_path, names=names, types=types, index_columns=index_columns, update=update, debug=debug, cache_size=cache_size)
+		self._sql_match = 'SELECT * FROM {0} WHERE {0} MATCH ?'.format(self.name)
+		self._match_templates = {}
+		self._code_queries = {}
 		logger.debug('ZIPLevel_GeoDB loaded.')
 
 	@classmethod
@@ -297,27 +553,86 @@ class ZIPLevel_GeoDB(GeoDatabase_Base):
 				pass
 			#POPULATING DATABASE FROM FILE
 			self.conn = sqlite3.connect(self.db_path)
-			self.cursor = self.conn.cursor()
-			self.cursor.execute('CREATE VIRTUAL TABLE geoinfo USING FTS5(country_code,zip_code,place_name,admin_name1,admin_code1,admin_name2,admin_code2,admin_name3,admin_code3,latitude,longitude,accuracy);')
+			_apply_pragmas(self.conn, bulk_load=True)
+			cursor = self.conn.cursor()
+			cursor.execute('CREATE VIRTUAL TABLE geoinfo USING FTS5(country_code,zip_code,place_name,admin_name1,admin_code1,admin_name2,admin_code2,admin_name3,admin_code3,latitude,longitude,accuracy);')
 			log_rss_memory_usage('Before populating FTS5 database.')
 			with gzip.open(self.original_db_path, 'rt') as odb:
 				query = odb.read()
 				log_rss_memory_usage('After reading sql database from file.')
-				self.cursor.execute(query)
+				cursor.execute(query)
 				self.conn.commit()
-				self.cursor.close()
+				cursor.close()
 				self.conn.close()
 				log_rss_memory_usage('After closing FTS5 database.')
 				del query
 				gc.collect()
 				logger.info('Database {} created.'.format(self.db_path))
 			log_rss_memory_usage('After populating FTS5 database.')
-		self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+		self.conn = sqlite3.connect(self.db_path)
+		_apply_pragmas(self.conn)
+		codes_table = '{}_codes'.format(self.name)
+		if self.update:
+			self._create_codes_table(codes_table)
+		self._has_codes_table = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (codes_table,)).fetchone() is not None
+		if not self._has_codes_table:
+			logger.warning('Table {} not found in {}, the code columns are queried in the FTS5 table. Update the database to create it.'.format(codes_table, self.db_path))
+		_set_query_only(self.conn, self.db_path)
 		self.conn.row_factory = self._dict_factory
 		self.conn.text_factory = str
 		return self.conn
 
-	def _get_geodata(self, column, value, multi_op='AND'):
+	def _create_codes_table(self, codes_table):
+		"""Creates a copy of the FTS5 table as a normal table with B-tree indices on the code columns. Only called when the database is created or updated.
+		The rows keep the order of the FTS5 table, so both tables return the same first result.
+		:param str codes_table: Name of the table.
+		"""
+		logger.info('Creating table {} with indices on {}.'.format(codes_table, self.code_columns))
+		with self.conn:
+			self.conn.execute('CREATE TABLE {} AS SELECT * FROM {} ORDER BY rowid'.format(codes_table, self.name))
+			for column in self.code_columns:
+				self.conn.execute('CREATE INDEX {0}_{1} ON {0}({1} COLLATE NOCASE)'.format(codes_table, column))
+
+	def _select_codes(self, columns, multi_op='AND'):
+		"""Returns the query of the codes table comparing each column with a ? parameter, or None if some column is not a code column or the database has no codes table.
+		The comparisons ignore the case, like the FTS5 queries.
+		"""
+		key = (tuple(columns), multi_op)
+		if key not in self._code_queries:
+			columns = [column.lower() for column in columns]
+			if not self._has_codes_table or multi_op not in ['AND', 'OR'] or not all(column in self.code_columns for column in columns):
+				query = None
+			else:
+				op = ' {} '.format(multi_op)
+				query = 'SELECT * FROM {}_codes WHERE {} ORDER BY rowid'.format(self.name, op.join(['"{}" = ? COLLATE NOCASE'.format(column) for column in columns]))
+			self._code_queries[key] = query
+		return self._code_queries[key]
+
+	def _match_template(self, columns, multi_op='AND'):
+		"""Returns the FTS5 query string for the given columns, with a {} for the value of each column. The values are searched as phrases.
+		The templates are built once for each list of columns.
+		:param columns: List of column names, or None to search the value in all the columns.
+		:param str multi_op: AND, OR or NOT.
+		:return: String with the template.
+		"""
+		key = (None if columns is None else tuple(columns), multi_op)
+		template = self._match_templates.get(key)
+		if template is None:
+			if columns is None:
+				template = '"{}"'
+			else:
+				columns = [column.lower() for column in columns]
+				for column in columns:
+					if column not in self.names:
+						raise ValueError('Unknown column |{}| in {}.'.format(column, self.name))
+				if multi_op not in ['AND', 'OR', 'NOT']:
+					raise ValueError('Invalid operator |{}|.'.format(multi_op))
+				op = ' {} '.format(multi_op)
+				template = op.join(['{}:"{{}}"'.format(column) for column in columns])
+			self._match_templates[key] = template
+		return template
+
+	def _get_geodata_single(self, column, value):
 		'''Documentation regarding FTS search: https://www.sqlite.org/fts3.html#full_text_index_queries
 		A query such as:
 		zipdb.get_geodata(['place_name', 'admin_name1', 'country_code'], ['MADRID', 'MADRID', 'ES'])
@@ -337,31 +652,41 @@ class ZIPLevel_GeoDB(GeoDatabase_Base):
 			'zip_code': '28001'
 		}
 		'''
-		if type(value) is str and type(column) is str and column in self.names:
-			query = 'SELECT * FROM {} WHERE {} MATCH "{}:{}"'.format(self.name, self.name, column.lower(), value.lower())
-		elif type(value) is str and type(column) is str and column not in self.names:
-			query = 'SELECT * FROM {} WHERE {} MATCH "{}"'.format(self.name, self.name, value.lower())
-		elif type(column) is list and type(value) is list and len(column) == len(value):
-			op = ' {} '.format(multi_op)
-			query = op.join(["{}:{}".format(c.lower(), v.lower()) for c, v in zip(column, value)])
-			query = 'SELECT * FROM {} WHERE {} MATCH "{}"'.format(self.name, self.name, query)
-		else:
+		if type(value) is not str:
 			return None
+		#the value is searched in all the columns if the column is unknown
+		return self._query([column] if column in self.names else None, [value])
+
+	def _get_geodata_multi(self, columns, values, multi_op='AND'):
+		"""Queries the database with many columns. See _get_geodata_single.
+		:param list columns: Columns to query.
+		:param list values: Values of the given columns.
+		:param str multi_op: AND, OR or NOT.
+		"""
+		return self._query(columns, values, multi_op)
 
-		self.cursor.execute(query)
+	def _query(self, columns, values, multi_op='AND'):
+		"""Queries the codes table if only code columns are compared with equality, and the FTS5 table otherwise.
+		:param columns: List of column names, or None to search the value in all the columns.
+		:param list values: Values of the given columns.
+		:param str multi_op: AND, OR or NOT.
+		"""
+		query = None if columns is None else self._select_codes(columns, multi_op)
+		if query is not None:
+			params = values
+		else:
+			#the values are quoted as FTS5 strings, so their characters are not FTS5 operators
+			query = self._sql_match
+			params = (self._match_template(columns, multi_op).format(*[v.lower().replace('"', '""') for v in values]),)
 
-		results = self.cursor.fetchall()
-		if results is None or len(results) == 0:
+		d, representative_point = self._query_first(query, params)
+		if d is None:
 			return None
 		#else
-		d = results[0]
-		d['location'] = '{},{}'.format(results[0]['latitude'], results[0]['longitude'])
+		d['location'] = '{},{}'.format(d['latitude'], d['longitude'])
 		d['representative_point'] = d['location']
-		if len(results) > 1:
-			geo_points = [(r['latitude'], r['longitude']) for r in results]
-			geo_points = MultiPoint(geo_points)
-			repr_lat, repr_lon = geo_points.representative_point().coords[0]
-			d['representative_point'] = '{},{}'.format(repr_lat, repr_lon)
+		if representative_point is not None:
+			d['representative_point'] = '{},{}'.format(*representative_point)
 
 		del d['latitude']
 		del d['longitude']
@@ -385,13 +710,13 @@ class ZIP_GeoIPDB(GeoDatabase_Base):
 		 'zip_code': '64830'
 	}
 	A representative point is a kind of centroid calculated when there are many. For example, if you query with country_code: US, there are many different entries.
-	The location dictionary would be populated with the first geopoint, and the rerpesentative_point would be calculated using the method representative_point of a shapely.geometry.MultiPoint
-	See https://toblerity.org/shapely/manual.html#object.representative_point
+	The location dictionary would be populated with the first geopoint, and the representative_point would be the median of the latitudes and longitudes of all the geopoints.
 	However, we would recommend using the CountryLevel_GeoDB class if queries are formed only with country_name and/or country_code, otherwise use this class.
 	"""
 	names   = ["ip_from", "ip_to", "country_code", "country_name", "region_name", "place_name", "latitude", "longitude", "zip_code"]
 	types   = {'ip_from': int, 'ip_to': int, 'country_code': str, 'country_name': str, 'region_name': str, 'place_name': str, 'latitude': float, 'longitude': float, 'zip_code': str}
 	indices = ['ip_to', 'ip_from']
+	ip_columns = ['ip_from', 'ip_to'] # stored as IP_DTYPE in the cache IP files
 	def __init__(self, *args, **kwargs):
 		if 'index_columns' not in kwargs:
 			kwargs['index_columns'] = ZIP_GeoIPDB.indices
@@ -404,50 +729,68 @@ class ZIP_GeoIPDB(GeoDatabase_Base):
 		self.db_folder = kwargs.pop('db_folder', os.path.join(get_script_path(), 'db'))
 		super(ZIP_GeoIPDB, self).__init__(*args, **kwargs)
 		self.ip_int_to_list = self._load_cache_ip_file()
-		# tempfile = StringIO()
-		# self.conn.row_factory = sqlite3.Row
-		# logger.info('dump...')
-		# for line in self.conn.iterdump():
-		# 	tempfile.write('%s\n' % line)
-		# self.conn.close()
-		# tempfile.seek(0)
-		# logger.info('loading from memory.')
-		# self.conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
-		# self.conn.execute('pragma journal_mode=wal')
-		# self.conn.execute('pragma cache_size = {}'.format(600*1000))
-		# self.conn.execute('pragma mmap_size = {}'.format(600*10**6))
-		# self.conn.execute('pragma synchronous = 0')
-		# self.conn.cursor().executescript(tempfile.read())
-		# self.conn.commit()
-		# self.conn.row_factory = self._dict_factory
-		# self.cursor = self.conn.cursor()
 		logger.info('ZIP_GeoIPDB DB9 loaded.')
 
 	def _load_cache_ip_file(self):
-		#LOADING DATABASE FROM FILE
-		cache_filename = os.path.join(self.db_folder, 'ip_int_to_list.npy')
-		if os.path.exists(cache_filename):
-			logger.info('File for cache IP_to file already exists.')
-			return np.load(cache_filename)
-		logger.info('Creating cache IP_to file.')
-		df = pd.read_csv(self.original_db_path, sep=self.separator, names=self.names, usecols=["ip_to"], dtype=self.types, compression=self.compression, keep_default_na=False, na_values=['-1.#IND', '1.#QNAN', '1.#IND', '-1.#QNAN', '#N/A N/A', '#N/A', 'N/A', 'n/a', '#NA', 'NULL', 'null', 'NaN', '-NaN', 'nan', '-nan', ''], encoding='utf-8')
-		np.save(cache_filename, df['ip_to'].values)
-		return df['ip_to'].values
-
-	# #@timeit
-	# def _n_search(self, value):
-	# 	idx = np.searchsorted(self.ip_int_to_list, value, side='right')
-	# 	return idx, self.ip_int_to_list[idx]
-
-	# #@timeit
-	# def _nnn_search(self, value):
-	# 	idx = bisect.bisect_right(self.ip_int_to_list, value)
-	# 	return idx, self.ip_int_to_list[idx]
-
-	def _get_geodata(self, column, value, multi_op='AND', str_ip=True):
-		"""Queries the database.
-		:param column: Column or list of columns to query.
-		:param value: Value or list of values of the given column/s. Provide the value/s in upper case.
+		"""Loads the columns of the database as numpy arrays, one .npy file per column, so the IP queries are answered without SQL.
+		The string columns are stored as an array with their distinct values and an int32 array with the position of the value of each row.
+		The files are created from the csv file if they do not exist, the database is updated or the IP columns were stored with another dtype. The arrays of the rows are memory mapped.
+		:return: The sorted array of ip_to values.
+		"""
+		str_columns = [column for column in self.names if self.types[column] is str]
+		num_columns = [column for column in self.names if self.types[column] is not str]
+		filenames = [self._cache_ip_filename(column) for column in num_columns]
+		filenames += [self._cache_ip_filename(column, suffix) for column in str_columns for suffix in ['codes', 'values']]
+		if self.update or not all(os.path.exists(filename) for filename in filenames) or any(np.load(self._cache_ip_filename(column), mmap_mode='r').dtype != IP_DTYPE for column in self.ip_columns):
+			logger.info('Creating cache IP files.')
+			#the generator is exhausted, so the parquet copy is completed if the database is updated
+			[df] = self._read_original_db()
+			for column in num_columns:
+				np.save(self._cache_ip_filename(column), df[column].values.astype(IP_DTYPE) if column in self.ip_columns else df[column].values)
+			for column in str_columns:
+				codes, values = pd.factorize(df[column].fillna('None'))
+				np.save(self._cache_ip_filename(column, 'codes'), codes.astype(np.int32))
+				np.save(self._cache_ip_filename(column, 'values'), np.asarray(values, dtype=str))
+			del df
+			gc.collect()
+		else:
+			logger.info('Cache IP files already exist.')
+		self.ip_num_columns = {column: np.load(self._cache_ip_filename(column), mmap_mode='r') for column in num_columns}
+		self.ip_str_columns = {column: (np.load(self._cache_ip_filename(column, 'codes'), mmap_mode='r'), np.load(self._cache_ip_filename(column, 'values')).tolist()) for column in str_columns}
+		return self.ip_num_columns['ip_to']
+
+	def _cache_ip_filename(self, column, suffix=None):
+		name = column if suffix is None else '{}_{}'.format(column, suffix)
+		return os.path.join(self.db_folder, 'ip_cache_{}.npy'.format(name))
+
+	def _get_ip_result(self, idx):
+		"""Builds the result of the IP queries in the range idx from the cache IP arrays."""
+		d = {column: values[codes[idx]] for column, (codes, values) in self.ip_str_columns.items()}
+		d['location'] = '{},{}'.format(float(self.ip_num_columns['latitude'][idx]), float(self.ip_num_columns['longitude'][idx]))
+		d['representative_point'] = d['location']
+		return d
+
+	def get_geodata_batch(self, ips, str_ip=True):
+		"""Queries the database with a list of IPs at once. The IPs are converted and searched by the kernels of geodb_kernels and the result of each range is built only once.
+		The results are not added to the result cache.
+		:param list ips: List of IPs in dot-decimal notation, or integers if str_ip is False.
+		:param bool str_ip: If True, the IPs are strings in dot-decimal notation.
+		:return: List with a dictionary like the ones of get_geodata('ip', ip) for each IP, or None if the IP is invalid or not found.
+		"""
+		values = ip2int_batch([str(ip) for ip in ips]) if str_ip else int_batch(ips)
+		indices = lookup_indices(values, self.ip_int_to_list)
+		found = np.flatnonzero(indices != NOT_FOUND)
+		#the IPs in a gap between ranges are not found
+		indices[found[self.ip_num_columns['ip_from'][indices[found]] > values[found]]] = NOT_FOUND
+		indices = indices.tolist()
+		results = {idx: self._get_ip_result(idx) for idx in set(indices) if idx != NOT_FOUND}
+		return [results.get(idx) for idx in indices]
+
+	def _get_geodata_single(self, column, value, str_ip=True):
+		"""Queries the database. The IP queries are answered from the cache IP arrays.
+		:param str column: Column to query, or ip.
+		:param value: Value of the given column. Provide the value in upper case.
+		:param bool str_ip: If True, the IPs are strings in dot-decimal notation.
 		:return: dictionary with geographical information like:
 		{
 			 'place_name': 'MONTERREY',
@@ -460,41 +803,41 @@ class ZIP_GeoIPDB(GeoDatabase_Base):
 		}
 		"""
 		if column == 'ip':
-			if str_ip:
-				try:
-					value = ip2int(str(value))
-				except Exception as e:
-					logger.warning('Error in ip2int with ip: |{}|'.format(str(value)))
-					return None
-			idx = bisect.bisect_right(self.ip_int_to_list, value)
-			ip_to = self.ip_int_to_list[idx]
-			query = 'SELECT * FROM {} WHERE ip_to = "{}"'.format(self.name, ip_to)
-			#query = 'SELECT * FROM {} WHERE {} BETWEEN ip_from AND ip_to'.format(self.name, value)
-		elif type(column) is str:
-			query = 'SELECT * FROM {} WHERE {} = "{}"'.format(self.name, column, value)
-		elif type(column) is list and type(value) is list and len(column) == len(value):
-			op = ' {} '.format(multi_op)
-			query = op.join(['"{}" = "{}"'.format(e[0], e[1]) for e in zip(column, value)])
-			query = 'SELECT * FROM {} WHERE {}'.format(self.name, query)
-		else:
-			return None
-		logger.debug('Query: {}'.format(query))
+			try:
+				value = ip2int(str(value)) if str_ip else int(value)
+			except Exception as e:
+				logger.warning('Error in ip2int with ip: |{}|'.format(str(value)))
+				return None
+			if value < 0 or len(self.ip_int_to_list) == 0 or value > self.ip_int_to_list[-1]:
+				return None
+			#first range with ip_to >= value, the ranges include both ends
+			idx = int(np.searchsorted(self.ip_int_to_list, IP_DTYPE(value), side='left'))
+			if self.ip_num_columns['ip_from'][idx] > value: # the IP is in a gap between ranges
+				return None
+			return self._get_ip_result(idx)
+		return self._query(self._select_equals([column]), (value,))
+
+	def _get_geodata_multi(self, columns, values, multi_op='AND'):
+		"""Queries the database with many columns.
+		:param list columns: Columns to query.
+		:param list values: Values of the given columns. Provide the values in upper case.
+		:param str multi_op: AND or OR.
+		:return: dictionary with geographical information like the one of _get_geodata_single.
+		"""
+		return self._query(self._select_equals(columns, multi_op), values)
+
+	def _query(self, query, params):
+		logger.debug('Query: {} Params: {}'.format(query, params))
 
-		self.cursor.execute(query)
-		results = self.cursor.fetchall()
-		logger.debug('Results {}'.format(results))
-		if results is None or len(results) == 0:
+		d, representative_point = self._query_first(query, params)
+		if d is None:
 			return None
-		d = results[0]
-		d['location'] = '{},{}'.format(results[0]['latitude'], results[0]['longitude'])
+		logger.debug('First result {}'.format(d))
+		d['location'] = '{},{}'.format(d['latitude'], d['longitude'])
 		d['representative_point'] = d['location']
-		if len(results) > 1:
-			logger.debug('More than 1 result. Creating centroid.')
-			geo_points = [(r['latitude'], r['longitude']) for r in results]
-			geo_points = MultiPoint(geo_points)
-			repr_lat, repr_lon = geo_points.representative_point().coords[0]
-			d['representative_point'] = '{},{}'.format(repr_lat, repr_lon)
-			logger.debug('Centroid done.')
+		if representative_point is not None:
+			logger.debug('More than 1 result, centroid computed.')
+			d['representative_point'] = '{},{}'.format(*representative_point)
 
 		for k in ['latitude', 'longitude', 'ip_from', 'ip_to', 'index']:
 			if k in d:
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from net_utils import ip2int
+from numba_utils import njit, prange, NUMBA_AVAILABLE
+
+NOT_FOUND = -1 # value of ip2int_batch for the IPs that can not be parsed and of lookup_indices for the IPs out of the ranges
+
+@njit(cache=True)
+def _parse_ips_njit(buf, out):
+	"""Parses the IPs in dot-decimal notation of buf, separated by new lines, and stores them in out.
+	Only IPs with four decimal numbers between 0 and 255 without leading zeros are parsed, anything else is stored as NOT_FOUND.
+	:return: The number of IPs found in buf.
+	"""
+	n = 0
+	i = 0
+	end = buf.shape[0]
+	while i <= end:
+		value = 0
+		part = 0
+		digits = 0
+		dots = 0
+		valid = True
+		while i < end and buf[i] != 10: # \n
+			c = int(buf[i])
+			if c >= 48 and c <= 57:
+				if digits > 0 and part == 0: # leading zero, octal for inet_aton
+					valid = False
+				part = part*10 + (c - 48)
+				digits += 1
+				if part > 255:
+					valid = False
+			elif c == 46 and digits > 0: # .
+				value = value*256 + part
+				part = 0
+				digits = 0
+				dots += 1
+			else:
+				valid = False
+			i += 1
+		if n < out.shape[0]:
+			if valid and digits > 0 and dots == 3:
+				out[n] = value*256 + part
+			else:
+				out[n] = NOT_FOUND
+		n += 1
+		i += 1
+	return n
+
+@njit(parallel=True, cache=True)
+def _lookup_indices_njit(ips, ip_to_sorted, out):
+	n_ranges = ip_to_sorted.shape[0]
+	for i in prange(ips.shape[0]):
+		value = ips[i]
+		if value < 0 or n_ranges == 0 or value > ip_to_sorted[n_ranges-1]:
+			out[i] = NOT_FOUND
+		else:
+			lo = 0
+			hi = n_ranges
+			while lo < hi:
+				mid = (lo + hi) // 2
+				if ip_to_sorted[mid] < value:
+					lo = mid + 1
+				else:
+					hi = mid
+			out[i] = lo
+
+def ip2int_batch(ips):
+	"""Converts a list of IPs in dot-decimal notation to an int64 array.
+	The IPs the kernel can not parse are converted with net_utils.ip2int, so the results are the same.
+	:param list ips: List of strings.
+	:return: int64 array with the IPs as integers, NOT_FOUND for the invalid IPs.
+	"""
+	out = np.full(len(ips), NOT_FOUND, dtype=np.int64)
+	if NUMBA_AVAILABLE and all(isinstance(ip, str) for ip in ips):
+		buf = np.frombuffer('\n'.join(ips).encode('utf-8'), dtype=np.uint8)
+		if _parse_ips_njit(buf, out) != len(ips): # some IP had a new line
+			out[:] = NOT_FOUND
+		pending = np.flatnonzero(out == NOT_FOUND).tolist()
+	else:
+		pending = range(len(ips))
+	for i in pending:
+		try:
+			out[i] = ip2int(ips[i])
+		except Exception:
+			out[i] = NOT_FOUND
+	return out
+
+def int_batch(ips):
+	"""Converts a list of IPs given as integers to an int64 array, coercing each value with int like the single queries.
+	:param list ips: List of integers or values int can convert.
+	:return: int64 array with the IPs, NOT_FOUND for the values that can not be converted or do not fit in an int64.
+	"""
+	try:
+		return np.asarray(ips, dtype=np.int64)
+	except (TypeError, ValueError, OverflowError):
+		pass
+	out = np.full(len(ips), NOT_FOUND, dtype=np.int64)
+	for i, ip in enumerate(ips):
+		try:
+			out[i] = int(ip)
+		except Exception:
+			out[i] = NOT_FOUND
+	return out
+
+def lookup_indices(ips, ip_to_sorted):
+	"""Finds the range of each IP.
+	:param ips: int64 array with the IPs.
+	:param ip_to_sorted: Sorted array with the last IP of each range, int64 or uint32. The ranges must be contiguous.
+	:return: int64 array with the index of the range of each IP, NOT_FOUND for negative IPs and IPs after the last range.
+	"""
+	ips = np.asarray(ips, dtype=np.int64)
+	ip_to_sorted = np.asarray(ip_to_sorted)
+	out = np.full(ips.shape[0], NOT_FOUND, dtype=np.int64)
+	if NUMBA_AVAILABLE:
+		_lookup_indices_njit(ips, ip_to_sorted, out)
+		return out
+	if ip_to_sorted.shape[0] == 0:
+		return out
+	#the IPs are cast to the dtype of the ranges, otherwise numpy casts the whole ranges array in every search
+	valid = (ips >= 0) & (ips <= ip_to_sorted[-1])
+	out[valid] = np.searchsorted(ip_to_sorted, ips[valid].astype(ip_to_sorted.dtype), side='left')
+	return out
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+try:
+	from numba import njit, prange
+	NUMBA_AVAILABLE = True
+except ImportError:
+	NUMBA_AVAILABLE = False
+	prange = range
+	def njit(*args, **kwargs):
+		"""Fallback decorator used when numba is not installed. The kernels keep working as plain python functions."""
+		if len(args) == 1 and callable(args[0]):
+			return args[0]
+		return lambda function: function
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from numba_utils import njit, NUMBA_AVAILABLE
+
+#column types understood by parse_line_njit
+TYPE_INTEGER = 0
+TYPE_LONG    = 1
+TYPE_DATE    = 2
+TYPE_FLOAT   = 3
+TYPE_STRING  = 4
+TYPE_CODES = {'integer': TYPE_INTEGER, 'long': TYPE_LONG, 'date': TYPE_DATE, 'float': TYPE_FLOAT}
+
+#status of each parsed field
+STATUS_OK       = 0 # value stored in out_int or out_float
+STATUS_NONE     = 1 # empty field
+STATUS_STRING   = 2 # string column, value is the slice between the offsets
+STATUS_FALLBACK = 3 # numeric value that the kernel can not parse exactly, parse it in python
+
+MAX_INT64 = 9.2e18
+MAX_EXACT_DIGITS = 15 # mantissas up to 15 digits are exact in a float64
+MAX_EXACT_POWER = 22  # 10**22 is the greatest power of 10 exact in a float64
+
+@njit(cache=True)
+def _is_space(c):
+	return c == 32 or (c >= 9 and c <= 13)
+
+@njit(cache=True)
+def _parse_number(line, start, end, col_type, dates_in_seconds, out_int, out_float, n):
+	"""Parses the bytes line[start:end] as a number and stores it in out_int[n] or out_float[n].
+	Only plain decimal numbers with up to 15 significant digits and exponents up to 22 are parsed, so the
+	result is the same of the python float() builtin. Anything else returns STATUS_FALLBACK.
+	:return: The status of the field.
+	"""
+	if start == end:
+		return STATUS_NONE
+	i = start
+	negative = False
+	c = int(line[i])
+	if c == 45 or c == 43: # - +
+		negative = c == 45
+		i += 1
+	mantissa = 0
+	digits = 0
+	significant = 0
+	exponent = 0
+	seen_point = False
+	while i < end:
+		c = int(line[i])
+		if c >= 48 and c <= 57:
+			digits += 1
+			if mantissa > 0 or c != 48:
+				significant += 1
+				if significant > MAX_EXACT_DIGITS:
+					return STATUS_FALLBACK
+				mantissa = mantissa*10 + (c - 48)
+			if seen_point:
+				exponent -= 1
+		elif c == 46 and not seen_point: # .
+			seen_point = True
+		else:
+			break
+		i += 1
+	if digits == 0:
+		return STATUS_FALLBACK
+	if i < end:
+		c = int(line[i])
+		if c != 101 and c != 69: # e E
+			return STATUS_FALLBACK
+		i += 1
+		exp_negative = False
+		if i < end and (int(line[i]) == 45 or int(line[i]) == 43):
+			exp_negative = int(line[i]) == 45
+			i += 1
+		if i == end or end - i > 4:
+			return STATUS_FALLBACK
+		exp_value = 0
+		while i < end:
+			c = int(line[i])
+			if c < 48 or c > 57:
+				return STATUS_FALLBACK
+			exp_value = exp_value*10 + (c - 48)
+			i += 1
+		exponent += -exp_value if exp_negative else exp_value
+	if mantissa == 0:
+		exponent = 0
+	if exponent > MAX_EXACT_POWER or exponent < -MAX_EXACT_POWER:
+		return STATUS_FALLBACK
+	value = float(mantissa)
+	if exponent > 0:
+		value = value * 10.0**exponent
+	elif exponent < 0:
+		value = value / 10.0**(-exponent)
+	if negative:
+		value = -value
+
+	if col_type == TYPE_FLOAT:
+		out_float[n] = value
+		return STATUS_OK
+	if col_type == TYPE_DATE and dates_in_seconds:
+		value = value*1000
+	if value >= MAX_INT64 or value <= -MAX_INT64:
+		return STATUS_FALLBACK
+	out_int[n] = int(value)
+	return STATUS_OK
+
+@njit(cache=True)
+def parse_line_njit(line, sep, col_types, dates_in_seconds, out_int, out_float, status, offsets):
+	"""Splits the line by sep and parses its numeric columns.
+	:param line: uint8 array with the bytes of the line.
+	:param sep: Byte value of the separator.
+	:param col_types: int8 array with the TYPE_* code of each column.
+	:param dates_in_seconds: If True, dates are multiplied by 1000.
+	:param out_int: int64 array where integer, long and date values are stored.
+	:param out_float: float64 array where float values are stored.
+	:param status: int8 array where the STATUS_* code of each field is stored.
+	:param offsets: int64 array of length 2*len(col_types) where the start and end of each field are stored.
+	:return: The number of fields of the line or -1 if there are more fields than columns.
+	"""
+	n_cols = col_types.shape[0]
+	end = line.shape[0]
+	while end > 0 and _is_space(line[end-1]):
+		end -= 1
+	n = 0
+	start = 0
+	while True:
+		j = start
+		while j < end and line[j] != sep:
+			j += 1
+		if n >= n_cols:
+			return -1
+		offsets[2*n] = start
+		offsets[2*n+1] = j
+		if col_types[n] >= TYPE_STRING:
+			status[n] = STATUS_STRING
+		else:
+			status[n] = _parse_number(line, start, j, col_types[n], dates_in_seconds, out_int, out_float, n)
+		n += 1
+		if j >= end:
+			break
+		start = j + 1
+	return n
+
+class TypedLineParser(object):
+	"""Parses the lines of the input file into dictionaries with typed values using parse_line_njit.
+	"""
+
+	def __init__(self, fields, types, separator, dates_in_seconds, fallback):
+		"""Creates a TypedLineParser object
+
+		:param list fields: Column names in the order of the file.
+		:param list types: Type of each column as written in the cfg file.
+		:param str separator: Single character separator of the file.
+		:param bool dates_in_seconds: If True, dates are multiplied by 1000.
+		:param fallback: Function (str_value, t) used to parse the values the kernel can not parse.
+		:return: A TypedLineParser object.
+		"""
+		self.fields = fields
+		self.types = types
+		self.sep = ord(separator)
+		self.dates_in_seconds = dates_in_seconds
+		self.fallback = fallback
+		n_cols = len(fields)
+		self.col_types = np.array([TYPE_CODES.get(t, TYPE_STRING) for t in types], dtype=np.int8)
+		self.is_float = [t == 'float' for t in types]
+		self.out_int = np.zeros(n_cols, dtype=np.int64)
+		self.out_float = np.zeros(n_cols, dtype=np.float64)
+		self.status = np.zeros(n_cols, dtype=np.int8)
+		self.offsets = np.zeros(2*n_cols, dtype=np.int64)
+
+	def parse(self, raw):
+		"""Parses a line.
+		:param bytes raw: The line encoded in utf-8. Invalid utf-8 characters are ignored.
+		:return: A dictionary with the parsed values.
+		"""
+		n = parse_line_njit(np.frombuffer(raw, dtype=np.uint8), self.sep, self.col_types, self.dates_in_seconds, self.out_int, self.out_float, self.status, self.offsets)
+		if n < 0:
+			raise ValueError('More fields than columns in the cfg file.')
+		status = self.status.tolist()
+		offsets = self.offsets.tolist()
+		ints = self.out_int.tolist()
+		floats = self.out_float.tolist()
+		dicc = {}
+		for i in range(n):
+			s = status[i]
+			if s == STATUS_STRING:
+				dicc[self.fields[i]] = raw[offsets[2*i]:offsets[2*i+1]].decode('utf-8', 'ignore')
+			elif s == STATUS_OK:
+				dicc[self.fields[i]] = floats[i] if self.is_float[i] else ints[i]
+			elif s == STATUS_NONE:
+				dicc[self.fields[i]] = None
+			else:
+				dicc[self.fields[i]] = self.fallback(raw[offsets[2*i]:offsets[2*i+1]].decode('utf-8', 'ignore'), self.types[i])
+		return dicc
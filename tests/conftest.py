@@ -5,12 +5,6 @@ import pandas as pd
 myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../')
 
-if sys.version_info < (3,0,0):
-	reload(sys)
-	sys.setdefaultencoding('utf8')
-else:
-	long = int
-
 from geodb import *
 from torinfo import *
 
@@ -24,14 +18,14 @@ def sample_ips():
 	ips  = ['192.168.2.1', '83.112.12.2', '172.14.12.12', '65.43.115.255']
 	ints = [3232236033, 1399852034, 2886601740, 1093366783]
 	masks= ['192.168.2.0/24', '83.112.12.0/24', '172.14.12.0/24', '65.43.115.0/24']
-	return zip(ips,ints,masks)
+	return list(zip(ips,ints,masks))
 
 @pytest.fixture(scope = 'session')
 def bad_sample_ips():
 	ips  = ['192.168.2.1', '83.112.12.2', '172.14.12.12', '65.43.115.255']
 	ints = [3232236033, 1399852034, 2886601740, 1093366783]
 	masks= ['192.168.2.0/24', '83.112.12.0/24', '172.14.12.0/24', '65.43.115.0/24']
-	return zip(ips,ints,masks[::-1])
+	return list(zip(ips,ints,masks[::-1]))
 
 @pytest.fixture(scope='session')
 def sessiondir(request):
@@ -18,23 +18,90 @@ class Test_elasticImporter(object):
 			assert is_nan_or_inf(float(value)) == result
 	
 	def test_parse_property(self):
-		args = {}
-		args['dates_in_seconds'] = True
-		args = objectview(args)
 		values = [('', 'float', None),
 		('+inf', 'float', None),
 		('inf', 'integer', None),
 		('1.1', 'float', 1.1),
-		('1', "long", long(1)),
+		('1', "long", 1),
 		('1', 'integer', int(1)),
 		('1', 'string', '1'),
 		('1519995883.3099031', 'date', 1519995883309)]
 		for v, t, r in values:
-			assert parse_property(v, t, args) == r
+			assert parse_property(v, t, True) == r
 
 	def test_no_all_no_source_args(self):
 		cfg = {u'order_in_file': [u'person', u'size', u'city'], u'meta': {u'index': u'example', u'type': u'my_doc'}, u'properties': {u'person': u'keyword', u'city': u'keyword', u'size': u'float'}}
 		doc = 'my_doc'
 		args = Namespace(bulk=2000, cfg='example.cfg', date_fields=[], dates_in_seconds=False, debug=False, deflate_compression=False, delete=True, extra_data=None, geo_column_country_code=None, geo_column_country_name=None, geo_column_ip=None, geo_column_place_name=None, geo_column_region_name=None, geo_column_zip_code=None, geo_fields={}, geo_int_ip=False, geo_precission=None, geodb=None, index=None, input='example.csv', md5_exclude=[], md5_id=False, no_all=True, no_source=True, node='localhost', noprogress=False, password='', port=9200, queue=6, raise_on_error=False, raise_on_exception=False, refresh=True, refresh_interval='60s', regenerate_databases=[], replicas=0, separator=',', shards=2, show_elastic_logger=False, skip_first_line=False, test_processing_speed=False, threads=5, timeout=600, tor_info=None, tor_info_from=False, tor_int_ip=False, type=None, typed_iterator=False, user=None, utf8=False)
 		doc_class = create_doc_class(cfg, doc, args)
-		assert doc_class.__dict__[doc] == {'_all': {'enabled': False}, '_source': {'enabled': False}}
\ No newline at end of file
+		assert doc_class.__dict__[doc] == {'_all': {'enabled': False}, '_source': {'enabled': False}}
+
+	def test_md5_calc(self):
+		args = objectview({'md5_exclude': ['city']})
+		mask = get_md5_mask([u'person', u'size', u'city'], args)
+		assert mask == [True, True, False]
+		assert md5_calc([b'potato', b'1.5', b'Bilbao'], mask) == md5_calc([b'potato', b'1.5', b'Madrid'], mask)
+		assert md5_calc([b'potato', b'1.5', b'Bilbao'], mask) != md5_calc([b'potato', b'2.5', b'Bilbao'], mask)
+		assert md5_calc([b'ab', b'c', b''], mask) != md5_calc([b'a', b'bc', b''], mask)
+
+	def test_typed_column(self):
+		pd = pytest.importorskip('pandas')
+		column = pd.Series(['1', '1.5', '', 'potato', 'inf', '1e3'], dtype=str)
+		assert typed_column(column, 'integer', False) == [1, 1, None, None, None, 1000]
+		assert typed_column(column, 'date', True) == [1000, 1500, None, None, None, 1000000]
+		assert typed_column(column, 'float', False) == [1.0, 1.5, None, None, None, 1000.0]
+		assert typed_column(column, 'keyword', False) == ['1', '1.5', '', 'potato', 'inf', '1e3']
+		assert typed_column(pd.Series(['a', None], dtype=str), 'text', False) == ['a', None]
+
+	def test_orjson_serializer(self):
+		pytest.importorskip('orjson')
+		serializer = ORJsonSerializer()
+		assert serializer.dumps('{"a": 1}') == '{"a": 1}'
+		assert json.loads(serializer.dumps({'a': 1, 'b': [1.5, None, u'Pérez']})) == {'a': 1, 'b': [1.5, None, u'Pérez']}
+		assert json.loads(serializer.dumps({'a': 10**30})) == {'a': 10**30}
+		assert serializer.loads('{"a": 1}') == {'a': 1}
+		with pytest.raises(SerializationError):
+			serializer.loads('{potato')
+
+	def test_parse_line(self):
+		cfg = {'order_in_file': ['name', 'size', 'timestamp'], 'properties': {'name': 'keyword', 'size': 'float', 'timestamp': 'date'}}
+		parse_plan = get_parse_plan(cfg)
+		assert parse_line(['potato', '1.5', '1519995883'], parse_plan, True) == {'name': 'potato', 'size': 1.5, 'timestamp': 1519995883000}
+		assert parse_line(['potato', 'big', ''], parse_plan, False) == {'name': 'potato', 'size': None, 'timestamp': None}
+		assert parse_line(['potato'], parse_plan, False) == {'name': 'potato'}
+		with pytest.raises(ValueError):
+			parse_line(['potato', '1', '1', 'extra'], parse_plan, False)
+
+	def test_pandas_iterator_geo_batch(self, ip_level_db):
+		import io
+		cfg = {'order_in_file': ['name', 'ip'], 'properties': {'name': 'keyword', 'ip': 'keyword'}}
+		args = objectview({'dates_in_seconds': False, 'geo_precission': 'ip', 'geo_column_ip': 'ip', 'geo_int_ip': False, 'geodb': ip_level_db, 'tor_info': None, 'extra_data': None, 'skip_first_line': False, 'separator': ',', 'bulk': 2})
+		f = io.BytesIO(b'a,8.8.8.8\nb,potato\nc,\nd,1.2.3.4\n')
+		documents = [doc['_source'] for doc in pandas_iterator(cfg, args, f)]
+		assert [doc['ip'] for doc in documents] == ['8.8.8.8', 'potato', '', '1.2.3.4']
+		for doc in documents:
+			assert doc == geo_append({'name': doc['name'], 'ip': doc['ip']}, args)
+		assert documents[0]['geo_place_name'] == 'MOUNTAIN VIEW'
+		assert 'geo_location' not in documents[1]
+
+	def test_producer_t_error(self):
+		def documents():
+			yield {'_source': '{}'}
+			raise ValueError('potato')
+		document_queue = queue.Queue()
+		errors = []
+		producer_t(documents(), [document_queue], 10, errors)
+		assert len(errors) == 1 and isinstance(errors[0], ValueError)
+		assert document_queue.get() == [{'_source': '{}'}]
+		assert document_queue.get() is None
+
+	def test_drain_results_failed_worker(self):
+		result_queue = queue.Queue()
+		result_queue.put((10, 1))
+		results = drain_results(result_queue, [objectview({'name': 'BulkP-0', 'exitcode': -9})])
+		assert next(results) == (10, 1)
+		with pytest.raises(RuntimeError):
+			next(results)
+		result_queue.put('The bulk process 1 failed.')
+		with pytest.raises(RuntimeError):
+			next(drain_results(result_queue, [objectview({'name': 'BulkP-0', 'exitcode': None})]))
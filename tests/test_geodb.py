@@ -15,6 +15,13 @@ class Test_geodb(object):
 		check_val = {'country_code': 'ES', 'country_name': 'SPAIN',  'location': '40.463667,-3.74922', 'representative_point': '40.463667,-3.74922'}
 		assert result == check_val
 		assert country_level_db.get_geodata('country_name', 'POTATO') is None
+		assert country_level_db.get_geodata(['country_code', 'country_name'], ['ES', 'SPAIN']) == check_val
+		assert country_level_db.get_geodata_multi(['country_code', 'country_name'], ['ES', 'SPAIN']) == check_val
+		assert country_level_db.get_geodata_single('country_code', 'ES') == check_val
+		assert country_level_db.get_geodata_multi(['country_code', 'country_name'], ['ES']) is None
+		assert country_level_db.get_geodata('country_name', '" OR 1=1 --') is None
+		with pytest.raises(ValueError):
+			country_level_db.get_geodata('potato', 'ES')
 
 	#MULTI LEVEL
 	def test_FTS5_support(self):
@@ -30,12 +37,36 @@ class Test_geodb(object):
 		assert result == check_val
 		assert multilevel_db.get_geodata('country_name', 'spain') is None
 		result = multilevel_db.get_geodata('country_code', 'FR')
-		check_val = {'accuracy': 5.0, 'location': '48.8534,2.3488', 'representative_point': '47.0011,2.7465', 'admin_name1': 'ÎLE-DE-FRANCE', 'admin_name2': 'PARIS', 'admin_name3': 'PARIS', 'admin_code2': '75', 'admin_code3': '751', 'country_code': 'FR', 'admin_code1': '11', 'country_name': None, 'zip_code': '75000', 'place_name': 'PARIS'}
+		check_val = {'accuracy': 5.0, 'location': '48.8534,2.3488', 'representative_point': '47.53505,2.4934', 'admin_name1': 'ÎLE-DE-FRANCE', 'admin_name2': 'PARIS', 'admin_name3': 'PARIS', 'admin_code2': '75', 'admin_code3': '751', 'country_code': 'FR', 'admin_code1': '11', 'country_name': None, 'zip_code': '75000', 'place_name': 'PARIS'}
 		assert result == check_val
+		assert multilevel_db.get_geodata('place_name', 'SAINT-DENIS') is not None
+		#empty accuracy in the dump, the field is left out
+		result = multilevel_db.get_geodata(['country_code', 'zip_code'], ['AT', '1010'])
+		assert result['place_name'] == 'WIEN, INNERE STADT' and 'accuracy' not in result
+		assert multilevel_db.get_geodata(['country_code', 'admin_code1'], ['es', 'Md'])['admin_code1'] == 'MD'
+		assert multilevel_db.get_geodata(['country_code', 'admin_code1'], ['ES', 'M']) is None
+		assert multilevel_db.get_geodata('place_name', 'MADRID" OR "BILBAO') is None
+		with pytest.raises(ValueError):
+			multilevel_db.get_geodata(['place_name', 'potato'], ['MADRID', 'MADRID'])
 		result = multilevel_db.get_geodata('', 'BILBAO')
 		check_val = {'accuracy': 4.0, 'location': '43.2627,-2.9253', 'representative_point': '43.2627,-2.9253', 'admin_name1': 'PAIS VASCO', 'admin_name2': 'VIZCAYA', 'admin_name3': 'BILBAO', 'admin_code2': 'BI', 'admin_code3': '48020', 'country_code': 'ES', 'admin_code1': 'PV', 'country_name': None, 'zip_code': '48001', 'place_name': 'BILBAO'}
 		assert result == check_val
 
+	def test_multilevel_db_without_codes_table(self, multilevel_db, sessiondir, script_path):
+		import shutil, sqlite3
+		#database created before the codes table, opened without update
+		db_path = str(sessiondir.join('db', 'multilevel_old.db'))
+		shutil.copyfile(multilevel_db.db_path, db_path)
+		conn = sqlite3.connect(db_path)
+		conn.execute('DROP TABLE geoinfo_codes')
+		conn.close()
+		old_db = ZIPLevel_GeoDB('geoinfo', '{}/db/create_zip_db.sql.gz'.format(script_path), db_path, update=False)
+		for columns, values in [('country_code', 'FR'), (['country_code', 'admin_code1'], ['es', 'Md']), (['country_code', 'zip_code'], ['AT', '1010'])]:
+			assert old_db.get_geodata(columns, values) == multilevel_db.get_geodata(columns, values)
+		conn = sqlite3.connect(db_path)
+		assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'geoinfo_codes'").fetchone() is None
+		conn.close()
+
 	#IP LEVEL
 	def test_ip_level_db(self, ip_level_db):
 		result = ip_level_db.get_geodata('ip', '8.8.8.8')
@@ -44,6 +75,42 @@ class Test_geodb(object):
 		result = ip_level_db.get_geodata('ip', 134744072, str_ip=False)
 		check_val = {'country_code': 'US', 'country_name': 'UNITED STATES', 'location': '37.405992,-122.078515', 'place_name': 'MOUNTAIN VIEW', 'region_name': 'CALIFORNIA', 'representative_point': '37.405992,-122.078515', 'zip_code': '94043'}
 		assert result == check_val
+		for ip in [-1, 2**32, 2**70, 'potato']:
+			assert ip_level_db.get_geodata('ip', ip, str_ip=False) is None
 
+	def test_ip_level_db_batch(self, ip_level_db):
+		ips = ['8.8.8.8', '83.112.12.2', 'potato', '8.8.8.8', '255.255.255.255', '1.2.3.4']
+		results = ip_level_db.get_geodata_batch(ips)
+		assert results[2] is None
+		for ip, result in zip(ips, results):
+			if result is not None:
+				assert result == ip_level_db.get_geodata('ip', ip)
+		assert ip_level_db.get_geodata_batch([134744072, -1, 2**32], str_ip=False) == [ip_level_db.get_geodata('ip', '8.8.8.8'), None, None]
+		#the values that can not be converted only invalidate their own IP
+		assert ip_level_db.get_geodata_batch([134744072, 2**70, 'potato', None], str_ip=False) == [ip_level_db.get_geodata('ip', '8.8.8.8'), None, None, None]
 
+	def test_results_cache(self, script_path, sessiondir):
+		db = CountryLevel_GeoDB('db0', '{}/db/countries.csv'.format(script_path), '{}/db/geodb0_cache.db'.format(str(sessiondir)), update=False, cache_size=2)
+		for country_code in ['ES', 'FR', 'ES', 'DE']:
+			db.get_geodata('country_code', country_code)
+		assert list(db._results_cache.keys()) == [('country_code', 'ES'), ('country_code', 'DE')]
 
+	def test_parquet_copy(self, script_path, sessiondir):
+		pa = pytest.importorskip('pyarrow')
+		pq = pytest.importorskip('pyarrow.parquet')
+		db_path = '{}/db/geodb0_parquet.db'.format(str(sessiondir))
+		parquet_path = '{}/db/geodb0_parquet.parquet'.format(str(sessiondir))
+		db = CountryLevel_GeoDB('db0', '{}/db/countries.csv'.format(script_path), db_path, update=True)
+		assert os.path.exists(parquet_path)
+		result = db.get_geodata(['country_code', 'country_name'], ['ES', 'SPAIN'])
+		db = CountryLevel_GeoDB('db0', '{}/db/countries.csv'.format(script_path), db_path, update=True)
+		assert db.get_geodata(['country_code', 'country_name'], ['ES', 'SPAIN']) == result
+		#a copy written with other types is not used
+		types = dict(CountryLevel_GeoDB.types, latitude=str)
+		CountryLevel_GeoDB('db0', '{}/db/countries.csv'.format(script_path), db_path, types=types, update=True)
+		assert pq.read_schema(parquet_path).field('latitude').type == pa.string()
+		#without update the csv file is read but the copy is not written
+		os.remove(parquet_path)
+		db.update = False
+		assert len(next(db._read_original_db())) > 0
+		assert not os.path.exists(parquet_path)
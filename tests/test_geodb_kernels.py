@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import numpy as np
+
+from geodb_kernels import *
+from net_utils import ip2int
+
+class Test_geodb_kernels(object):
+	def test_ip2int_batch(self, sample_ips):
+		sample_ips = list(sample_ips)
+		assert ip2int_batch([ip for ip, int_ip, mask in sample_ips]).tolist() == [int_ip for ip, int_ip, mask in sample_ips]
+		#the same results of ip2int, also for the IPs parsed by inet_aton in python
+		ips = ['0.0.0.0', '255.255.255.255', '1.2.3', '010.1.1.1', '1.2.3.4\n', '256.1.1.1', ' 1.2.3.4', '1..2.3', '1.2.3.4.5', '', 'potato']
+		expected = [0, 4294967295, ip2int('1.2.3'), ip2int('010.1.1.1'), ip2int('1.2.3.4'), NOT_FOUND, NOT_FOUND, NOT_FOUND, NOT_FOUND, NOT_FOUND, NOT_FOUND]
+		assert ip2int_batch(ips).tolist() == expected
+
+	def test_int_batch(self):
+		assert int_batch([1, 2**32, -1]).tolist() == [1, 2**32, -1]
+		assert int_batch([1, '7', 2**70, 'potato', None]).tolist() == [1, 7, NOT_FOUND, NOT_FOUND, NOT_FOUND]
+
+	def test_lookup_indices(self):
+		ip_to = np.array([9, 19, 29], dtype=np.int64)
+		ips = np.array([0, 9, 10, 19, 25, 29, 30, -1], dtype=np.int64)
+		assert lookup_indices(ips, ip_to).tolist() == [0, 0, 1, 1, 2, 2, NOT_FOUND, NOT_FOUND]
+		assert lookup_indices(ips, ip_to.astype(np.uint32)).tolist() == [0, 0, 1, 1, 2, 2, NOT_FOUND, NOT_FOUND]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from parse_utils import *
+
+def fallback(str_value, t):
+	return 'fallback'
+
+class Test_parse_utils(object):
+	def test_parse_numbers(self):
+		parser = TypedLineParser(['a', 'b', 'c', 'd'], ['integer', 'long', 'date', 'float'], ';', False, fallback)
+		values = ['1', '-2', '0.5', '1e3', '.25', '5.', '+7', '-0.0015', '123456789012345', '0.1e-5', '12.5E+2']
+		for value in values:
+			line = ';'.join([value]*4).encode('utf-8')
+			result = parser.parse(line)
+			assert result == {'a': int(float(value)), 'b': int(float(value)), 'c': int(float(value)), 'd': float(value)}
+			assert type(result['d']) is float
+
+	def test_parse_dates_in_seconds(self):
+		parser = TypedLineParser(['timestamp'], ['date'], ';', True, fallback)
+		assert parser.parse(b'1519995883.309') == {'timestamp': int(1519995883.309*1000)}
+
+	def test_parse_fallback(self):
+		parser = TypedLineParser(['a'], ['float'], ';', False, fallback)
+		for value in ['inf', 'nan', '1_000', ' 1', '1234567890123456', '1e400', '1e', '.', '-', 'potato']:
+			assert parser.parse(value.encode('utf-8')) == {'a': 'fallback'}
+
+	def test_parse_strings(self):
+		parser = TypedLineParser(['name', 'size', 'city'], ['keyword', 'float', 'text'], ',', False, fallback)
+		assert parser.parse(u'Pérez,,Bilbao\r\n'.encode('utf-8')) == {'name': u'Pérez', 'size': None, 'city': u'Bilbao'}
+		assert parser.parse(b'potato') == {'name': u'potato'}
+		assert parser.parse(b'potato,1,') == {'name': u'potato', 'size': 1.0, 'city': u''}
+		with pytest.raises(ValueError):
+			parser.parse(b'potato,1,Bilbao,extra')